@@ -23,77 +23,840 @@ import shutil
 from datetime import datetime
 import re
 import io
+import hashlib
+import json
+import threading
+import stat
+import contextlib
+import locale
+import mmap
+import glob
+import heapq
+import time
+import select
+import struct
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class ArgumentHelper:
 
     @staticmethod
-    def earliest_timestamp(filelist):
+    def file_stat(filename, statcache=None):
+        # One stat call per file; None unless it is a regular file
+        if not filename:
+            return None
+        if statcache:
+            return statcache.stat(filename)
+
+        try:
+            result = os.stat(filename)
+        except (OSError, ValueError):
+            return None
+
+        return result if stat.S_ISREG(result.st_mode) else None
+
+    @staticmethod
+    def earliest_timestamp(filelist, statcache=None):
+        # None if any of the files is missing
         result = None
         for filename in filelist:
-            timestamp = datetime.utcfromtimestamp(os.path.getmtime(filename)) if os.path.isfile(filename) else None
+            if not filename:
+                continue
+            filestat = ArgumentHelper.file_stat(filename, statcache)
+            if not filestat:
+                return None
+            timestamp = datetime.utcfromtimestamp(filestat.st_mtime)
             if (not result) or timestamp < result:
                 result = timestamp
 
         return result
 
     @staticmethod
-    def latest_timestamp(filelist):
+    def latest_timestamp(filelist, statcache=None):
+        # Missing files are ignored
         result = None
         for filename in filelist:
-            timestamp = datetime.utcfromtimestamp(os.path.getmtime(filename)) if os.path.isfile(filename) else None
+            filestat = ArgumentHelper.file_stat(filename, statcache)
+            if not filestat:
+                continue
+            timestamp = datetime.utcfromtimestamp(filestat.st_mtime)
             if (not result) or timestamp > result:
                 result = timestamp
 
         return result
 
+    chunksize = 1 << 16
+
     @staticmethod
-    def read_comments(source):
-        comments = ''
+    def scan_comments(buffer, position=0, final=True, max_size=None):
+        # Finds the end of the block of lines starting with '#' in a str, bytes or mmap buffer.
+        # Returns that position and whether it is the end of the block, which is not known if
+        # the buffer ends part way through a line and more data may follow.
+        hashmark = '#' if isinstance(buffer, str) else b'#'
+        newline = '\n' if isinstance(buffer, str) else b'\n'
+        done = final
+        while position < len(buffer):
+            if buffer[position:position + 1] != hashmark:
+                done = True
+                break
+            # With a limit, a long line is only searched as far as the limit
+            end = buffer.find(newline, position) if max_size is None else buffer.find(newline, position, max_size + 1)
+            if end < 0:
+                if max_size is not None and len(buffer) > max_size:
+                    raise RuntimeError("Comments are longer than " + str(max_size) + " characters.")
+                if final:
+                    position = len(buffer)
+                break
+            position = end + 1
+            if max_size is not None and position > max_size:
+                raise RuntimeError("Comments are longer than " + str(max_size) + " characters.")
+
+        return position, done
+
+    @staticmethod
+    def read_chunks(fileobject, max_size=None):
+        # Reads the comments from the current position of a seekable file in large chunks,
+        # then seeks back to the first character after them.
+        parts = []
+        size = 0
+        pending = fileobject.read(ArgumentHelper.chunksize)
+        final = not pending
+        while True:
+            position, done = ArgumentHelper.scan_comments(pending, 0, final, None if max_size is None else max_size - size)
+            parts.append(pending[:position])
+            size += position
+            if done:
+                break
+
+            pending = pending[position:]
+            if pending:
+                # A comment line that goes on past the buffer: read on to its end looking only
+                # at the new data, rather than scanning the whole line again for each chunk
+                newline = '\n' if isinstance(pending, str) else b'\n'
+                line = [pending]
+                linesize = len(pending)
+                while True:
+                    if max_size is not None and size + linesize > max_size:
+                        raise RuntimeError("Comments are longer than " + str(max_size) + " characters.")
+                    chunk = fileobject.read(ArgumentHelper.chunksize)
+                    end = chunk.find(newline)
+                    if not chunk or end >= 0:
+                        break
+                    line.append(chunk)
+                    linesize += len(chunk)
+                if chunk:
+                    line.append(chunk[:end + 1])
+                    linesize += end + 1
+                    if max_size is not None and size + linesize > max_size:
+                        raise RuntimeError("Comments are longer than " + str(max_size) + " characters.")
+                parts.append(pending[:0].join(line))
+                size += linesize
+                if not chunk:
+                    break
+                pending = chunk[end + 1:]
+
+            chunk = fileobject.read(ArgumentHelper.chunksize)
+            final = not chunk
+            pending = pending + chunk
+
+        return parts[0][:0].join(parts), size
+
+    @staticmethod
+    def read_peeked(fileobject, max_size=None):
+        # Reads the comments from a buffered binary stream that cannot seek, by peeking at
+        # its buffer and then reading exactly the comment lines found there.
+        parts = []
+        size = 0
+        while True:
+            data = fileobject.peek(ArgumentHelper.chunksize)
+            if not data:
+                break
+            position, done = ArgumentHelper.scan_comments(data, 0, False, None if max_size is None else max_size - size)
+            if not position and not done:   # Line longer than the buffer
+                parts.append(fileobject.readline(-1 if max_size is None else max_size - size + 1))
+                size += len(parts[-1])
+                if max_size is not None and size > max_size:
+                    raise RuntimeError("Comments are longer than " + str(max_size) + " characters.")
+                continue
+            parts.append(fileobject.read(position))
+            size += position
+            if done:
+                break
+
+        return b''.join(parts), size
+
+    @staticmethod
+    def decode_comments(comments, encoding=None):
+        comments = comments.decode(encoding or locale.getpreferredencoding(False))
+        if '\r' in comments:   # Universal newlines, as in text mode
+            comments = comments.replace('\r\n', '\n').replace('\r', '\n')
+        return comments
+
+    @staticmethod
+    def read_comments(source, max_size=None):
+        # Returns the block of comment lines at the start of a file or at the current position
+        # of a file object, leaving the file object positioned at the first line after them.
         if isinstance(source, str):
-            if os.path.isfile(source):
-                fileobject = open(source, 'r')
-            else:
-                fileobject = None
+            if not os.path.isfile(source):
+                return ''
+            with open(source, 'rb') as fileobject:
+                return ArgumentHelper.decode_comments(fileobject.read(ArgumentHelper.header_size(fileobject, max_size)))
         elif source is not None:    # Not sure why peekable object returns False
             fileobject = source
         else:
             fileobject = sys.stdin
 
-        if fileobject:
-            if hasattr(fileobject, 'seekable') and fileobject.seekable():
-                while True:
-                    pos = fileobject.tell()
-                    line = fileobject.readline()
-                    if len(line):
-                        if line[0] == '#':
-                            comments += line
-                        else:
-                            fileobject.seek(pos)
-                            break
-                    else:
-                        break
+        if not fileobject:
+            return ''
+
+        seekable = hasattr(fileobject, 'seekable') and fileobject.seekable()
+        if hasattr(fileobject, 'buffer') and seekable:
+            # Text file: read the underlying bytes, then put the text file at the data
+            start = fileobject.tell()
+            fileobject.buffer.seek(start)
+            comments, size = ArgumentHelper.read_chunks(fileobject.buffer, max_size)
+            fileobject.seek(start + size)
+            return ArgumentHelper.decode_comments(comments, fileobject.encoding)
+        elif hasattr(fileobject, 'buffer') and hasattr(fileobject.buffer, 'peek'):
+            # Text stream such as standard input that has not been read from yet
+            comments, size = ArgumentHelper.read_peeked(fileobject.buffer, max_size)
+            return ArgumentHelper.decode_comments(comments, fileobject.encoding)
+        elif seekable:
+            start = fileobject.tell()
+            comments, size = ArgumentHelper.read_chunks(fileobject, max_size)
+            fileobject.seek(start + size)
+            return ArgumentHelper.decode_comments(comments) if isinstance(comments, bytes) else comments
+        elif isinstance(fileobject, io.BufferedIOBase) and hasattr(fileobject, 'peek'):
+            return ArgumentHelper.decode_comments(ArgumentHelper.read_peeked(fileobject, max_size)[0])
+        elif not hasattr(fileobject, 'peek'):
+            raise RuntimeError("Source file object must be seekable or peekable.")
+
+        # Peekable iterator over lines
+        comments = ''
+        while fileobject:
+            peek = fileobject.peek()
+            if peek[:1] == '#':
+                comments += next(fileobject)
+                if max_size is not None and len(comments) > max_size:
+                    raise RuntimeError("Comments are longer than " + str(max_size) + " characters.")
             else:
-                if not hasattr(fileobject, 'peek'):
-                    raise RuntimeError("Source file object must be seekable or peekable.")
+                break
 
-                while True:
-                    peek = fileobject.peek()
-                    if peek[0] == '#':
-                        comments += next(fileobject)
-                    else:
-                        break
+        return comments
 
+    @staticmethod
+    def header_size(source, max_size=None):
+        # Size in bytes of the block of comment lines at the start of a file, found by
+        # mapping the file into memory rather than reading it line by line.
+        fileobject = open(source, 'rb') if isinstance(source, str) else source
+        try:
+            if not os.fstat(fileobject.fileno()).st_size:
+                return 0
+            with mmap.mmap(fileobject.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return ArgumentHelper.scan_comments(mapped, 0, True, max_size)[0]
+        finally:
             if isinstance(source, str):
                 fileobject.close()
 
-        return comments
+    @staticmethod
+    def copy_range(infile, outfile, offset, count):
+        # Copy data between files inside the kernel where possible, so that large files do
+        # not have to pass through Python buffers.
+        infd = infile.fileno()
+        outfd = outfile.fileno()
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while count > 0:
+                    copied = os.copy_file_range(infd, outfd, count, offset)
+                    if not copied:
+                        break
+                    offset += copied
+                    count -= copied
+                return
+            except OSError:
+                pass
+
+        if hasattr(os, 'sendfile'):
+            try:
+                while count > 0:
+                    copied = os.sendfile(outfd, infd, offset, count)
+                    if not copied:
+                        break
+                    offset += copied
+                    count -= copied
+                return
+            except OSError:
+                pass
+
+        infile.seek(offset)
+        while count > 0:
+            chunk = infile.read(min(count, 1 << 20))
+            if not chunk:
+                break
+            outfile.write(chunk)
+            count -= len(chunk)
 
     @staticmethod
     def separator(header=None):
         return ((' ' + header + ' ') if header else '').center(80, '#') + '\n'
 
+    @staticmethod
+    def mtime_ns(filename):
+        try:
+            return os.stat(filename).st_mtime_ns
+        except OSError:
+            return None
+
+    locksuffix = '.argrecord.lock'
+
+    @staticmethod
+    @contextlib.contextmanager
+    def lock(filename):
+        # Advisory lock shared by everything that writes to the same log. The lock is taken
+        # on a separate file since the log itself is replaced rather than rewritten.
+        if fcntl is None:
+            yield
+            return
+
+        lockfd = os.open(filename + ArgumentHelper.locksuffix, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(lockfd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lockfd)
+
+    @staticmethod
+    def replace(tempname, dest, backup=None):
+        # Moves a finished temporary file into place. Any backup is made as a hard link to
+        # the old file, so that dest itself is never missing, even for a moment.
+        if os.path.isfile(dest):
+            shutil.copymode(dest, tempname)
+            if backup:
+                try:
+                    if os.path.lexists(dest + backup):
+                        os.remove(dest + backup)
+                    os.link(dest, dest + backup)
+                except OSError:
+                    shutil.copy2(dest, dest + backup)
+        os.replace(tempname, dest)
+
+class _Locked():
+
+    def __getstate__(self):
+        # Locks cannot be pickled, so a new one is made when sent to another process
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+class StatCache(_Locked):
+
+    # Remembers the result of stat for each file so that each file is only looked at once
+    # during a run, however many recipes refer to it. Entries must be invalidated when the
+    # file is written.
+
+    def __init__(self, threads=0):
+        self.threads = threads
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def stat(self, filename):
+        filename = os.path.normpath(filename)
+        with self.lock:
+            if filename in self.stats:
+                return self.stats[filename]
+
+        try:
+            result = os.stat(filename)
+            if not stat.S_ISREG(result.st_mode):
+                result = None
+        except (OSError, ValueError):
+            result = None
+
+        with self.lock:
+            self.stats[filename] = result
+
+        return result
+
+    def prefetch(self, filelist):
+        # Stat many files at once, in parallel if threads were requested, which helps on
+        # network filesystems where each stat is a round trip.
+        with self.lock:
+            filelist = set(filename for filename in (os.path.normpath(filename) for filename in filelist if filename) if filename not in self.stats)
+        if self.threads and len(filelist) > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+                list(executor.map(self.stat, filelist))
+        else:
+            for filename in filelist:
+                self.stat(filename)
+
+    def invalidate(self, filelist):
+        with self.lock:
+            for filename in filelist:
+                if filename:
+                    self.stats.pop(os.path.normpath(filename), None)
+
+class PathResolver(_Locked):
+
+    # Finds scripts and commands on PATH, remembering what is in each directory on it so that
+    # looking up many names costs one listing of each directory rather than a stat of every
+    # candidate file. Lookups are kept for each value of PATH, and directories are listed
+    # again if their modification time has changed when refresh is called.
+
+    def __init__(self):
+        self.directories = {}
+        self.resolved = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def usable(filename, executable):
+        return os.path.isfile(filename) and (not executable or os.access(filename, os.X_OK))
+
+    def listing(self, directory):
+        with self.lock:
+            if directory in self.directories:
+                return self.directories[directory][1]
+
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            names = frozenset(os.listdir(directory))
+        except OSError:
+            mtime = None
+            names = frozenset()
+
+        with self.lock:
+            self.directories[directory] = (mtime, names)
+        return names
+
+    def refresh(self):
+        # Checks each directory listed so far once, forgetting it and every lookup if it has
+        # changed. Returns whether anything had changed.
+        with self.lock:
+            directories = list(self.directories.items())
+
+        changed = [directory for directory, (mtime, names) in directories if ArgumentHelper.mtime_ns(directory) != mtime]
+        if changed:
+            with self.lock:
+                for directory in changed:
+                    self.directories.pop(directory, None)
+                self.resolved = {}
+
+        return bool(changed)
+
+    def lookup(self, name, executable=True, current=False):
+        # The first file called name in the directories on PATH, which must be executable if
+        # executable is set, or None. With current set the current directory is tried first.
+        # A command whose name has a directory part is used as it is, as by the operating
+        # system.
+        if current and PathResolver.usable(name, executable):
+            return name
+        if executable and os.sep in name:
+            return name if PathResolver.usable(name, executable) else None
+
+        path = os.environ.get('PATH', os.defpath)
+        key = (path, name, executable)
+        with self.lock:
+            if key in self.resolved:
+                return self.resolved[key]
+
+        result = None
+        cacheable = True
+        for directory in path.split(os.pathsep):
+            candidate = os.path.join(directory, name)
+            if not os.path.isabs(directory) or os.sep in name:
+                # Relative directories depend on the current directory, so are not listed
+                cacheable = False
+                if PathResolver.usable(candidate, executable):
+                    result = candidate
+                    break
+            elif name in self.listing(directory) and PathResolver.usable(candidate, executable):
+                result = candidate
+                break
+
+        if cacheable:
+            with self.lock:
+                self.resolved[key] = result
+        return result
+
+    def resolve_all(self, names):
+        # Returns the path of each command and a list of the commands that could not be found,
+        # looking again at any directory that has changed before giving up on one.
+        resolved = { name: self.lookup(name) for name in set(names) }
+        missing = [name for name in resolved if resolved[name] is None]
+        if missing and self.refresh():
+            for name in missing:
+                resolved[name] = self.lookup(name)
+            missing = [name for name in missing if resolved[name] is None]
+
+        return resolved, sorted(missing)
+
+class FileWatcher():
+
+    # Waits for any of a set of files to change. On Linux the directory holding each file is
+    # watched with inotify, so that files replaced by renaming are seen as well as those
+    # written in place; elsewhere, or where a directory cannot be watched, the files are
+    # looked at every interval seconds. Either way a file only counts as changed if its
+    # size, timestamps or inode differ from when it was last seen, so that files written by
+    # the watcher's owner can be marked as seen and not report their own writes.
+
+    inotifymask = 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # ATTRIB, CLOSE_WRITE, MOVED_FROM/TO, CREATE, DELETE
+    inotifyoverflow = 0x4000
+    inotifyignored  = 0x8000
+
+    def __init__(self, interval=1.0, inotify=True):
+        self.interval = interval
+        self.signatures = {}
+        self.directories = {}
+        self.watches = {}
+        self.candidates = set()
+        self.libc = None
+        self.fd = self.start_inotify() if inotify else None
+
+    def start_inotify(self):
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+
+        self.libc = libc
+        return fd
+
+    @staticmethod
+    def signature(filename):
+        try:
+            result = os.stat(filename)
+        except (OSError, ValueError):
+            return None
+        return (result.st_mtime_ns, result.st_ctime_ns, result.st_size, result.st_ino)
+
+    def watch(self, filenames):
+        # Replaces the set of files to watch. Files already being watched keep what was last
+        # seen of them, so that a change made while the set is being replaced is not lost.
+        filenames = set(os.path.normpath(filename) for filename in filenames if filename)
+        self.signatures = { filename: self.signatures[filename] if filename in self.signatures else FileWatcher.signature(filename) for filename in filenames }
+        self.directories = {}
+        for filename in filenames:
+            self.directories.setdefault(os.path.dirname(filename) or os.curdir, set()).add(filename)
+        if self.fd is not None:
+            for directory in self.directories:
+                if directory not in self.watches.values():
+                    watch = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), FileWatcher.inotifymask)
+                    if watch >= 0:
+                        self.watches[watch] = directory
+
+    def polled(self):
+        # Files that inotify is not watching for us
+        if self.fd is None:
+            return list(self.signatures)
+        watched = set(self.watches.values())
+        return [filename for directory, filenames in self.directories.items() if directory not in watched for filename in filenames]
+
+    def seen(self, filenames):
+        # Takes the current state of files as seen, so that changes up to now are not reported
+        for filename in filenames:
+            filename = os.path.normpath(filename)
+            if filename in self.signatures:
+                self.signatures[filename] = FileWatcher.signature(filename)
+
+    def changed(self, filenames):
+        # Those of the files that have changed since they were last seen, which they now have
+        result = []
+        for filename in filenames:
+            if filename in self.signatures:
+                signature = FileWatcher.signature(filename)
+                if signature != self.signatures[filename]:
+                    self.signatures[filename] = signature
+                    result.append(filename)
+        return result
+
+    def read_events(self, timeout):
+        # Waits up to timeout seconds for inotify events, adding the files they name to the
+        # candidates for having changed
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            position = 0
+            while position < len(buffer):
+                watch, mask, cookie, length = struct.unpack_from('iIII', buffer, position)
+                name = buffer[position + 16:position + 16 + length].rstrip(b'\0')
+                position += 16 + length
+                if mask & FileWatcher.inotifyoverflow:
+                    self.candidates.update(self.signatures)
+                elif mask & FileWatcher.inotifyignored:
+                    # The directory has gone, so its files are polled from now on
+                    directory = self.watches.pop(watch, None)
+                    self.candidates.update(self.directories.get(directory, ()))
+                elif watch in self.watches:
+                    self.candidates.add(os.path.normpath(os.path.join(self.watches[watch], os.fsdecode(name))))
+
+    def check(self, timeout):
+        # The files that have changed, waiting up to timeout seconds for one to change
+        deadline = time.monotonic() + timeout
+        while True:
+            candidates = self.candidates
+            self.candidates = set()
+            result = self.changed(list(candidates) + self.polled())
+            remaining = deadline - time.monotonic()
+            if result or remaining <= 0:
+                return result
+
+            if self.fd is None:
+                time.sleep(min(remaining, self.interval))
+            else:
+                self.read_events(min(remaining, self.interval) if self.polled() else remaining)
+
+    def wait(self, debounce=0.2, stop=None):
+        # Waits for files to change and returns them once none has changed for debounce
+        # seconds, so that a burst of writes is reported as one change. Returns an empty list
+        # if the stop event is set first.
+        result = set()
+        while not result:
+            if stop is not None and stop.is_set():
+                return []
+            result.update(self.check(self.interval))
+
+        while True:
+            more = self.check(debounce)
+            if not more:
+                return sorted(result)
+            result.update(more)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class HashCache(_Locked):
+
+    default_filename = 'argrecord.hash'
+
+    def __init__(self, filename=None):
+        self.filename = filename or HashCache.default_filename
+        self.files = {}
+        self.builds = {}
+        self.lock = threading.Lock()
+        self.modified = False
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as cachefile:
+                cache = json.load(cachefile)
+            self.files = cache.get('files', {})
+            self.builds = cache.get('builds', {})
+
+    def digest(self, filename, statcache=None):
+        # Files are only re-hashed when their size, modification time or inode has changed
+        filestat = ArgumentHelper.file_stat(filename, statcache)
+        if not filestat:
+            return None
+
+        path = os.path.abspath(filename)
+        key = [filestat.st_size, filestat.st_mtime_ns, filestat.st_ino]
+        with self.lock:
+            entry = self.files.get(path)
+        if entry and entry[:3] == key:
+            return entry[3]
+
+        filehash = hashlib.sha256()
+        with open(path, 'rb') as fileobject:
+            for chunk in iter(lambda: fileobject.read(1 << 20), b''):
+                filehash.update(chunk)
+
+        with self.lock:
+            self.files[path] = key + [filehash.hexdigest()]
+            self.modified = True
+
+        return filehash.hexdigest()
+
+    def changed(self, inputs, outputs, statcache=None):
+        # Returns None when there is no record to compare against, so that the caller can
+        # fall back to comparing timestamps.
+        inputs  = [filename for filename in inputs  if filename]
+        outputs = [filename for filename in outputs if filename]
+        if not inputs or not outputs:
+            return None
+
+        if not all(ArgumentHelper.file_stat(filename, statcache) for filename in outputs):
+            return True
+
+        digests = { os.path.abspath(filename): self.digest(filename, statcache) for filename in inputs }
+        with self.lock:
+            records = [self.builds.get(os.path.abspath(filename)) for filename in outputs]
+        if not all(records):
+            return None
+
+        return any(record != digests for record in records)
+
+    def record(self, inputs, outputs, statcache=None):
+        digests = { os.path.abspath(filename): self.digest(filename, statcache) for filename in inputs if filename }
+        for filename in outputs:
+            if filename:
+                self.digest(filename, statcache)
+                with self.lock:
+                    self.builds[os.path.abspath(filename)] = digests
+                    self.modified = True
+
+    def save(self):
+        with self.lock:
+            if not self.modified:
+                return
+
+            # Drop entries for files that no longer exist so the cache does not grow forever
+            self.files = { path: entry for path, entry in self.files.items() if os.path.isfile(path) }
+            self.builds = { path: record for path, record in self.builds.items() if os.path.isfile(path) }
+            tempname = self.filename + '.' + str(os.getpid())
+            with open(tempname, 'w') as cachefile:
+                json.dump({ 'files': self.files, 'builds': self.builds }, cachefile)
+            os.replace(tempname, self.filename)
+            self.modified = False
+
+class BuildCache(_Locked):
+
+    # Directory of outputs keyed by the command that produced them and the content of its
+    # inputs, so that a deterministic command that has been run before, anywhere, can be
+    # replaced by copying its outputs. Least recently used entries are removed once the
+    # cache grows beyond its maximum size.
+
+    default_directory = os.path.join(os.path.expanduser('~'), '.cache', 'argrecord')
+
+    def __init__(self, directory=None, maxsize=1 << 30, hashcache=None):
+        self.directory = directory or BuildCache.default_directory
+        self.maxsize = maxsize
+        os.makedirs(self.directory, exist_ok=True)
+        self.hashcache = hashcache or HashCache(os.path.join(self.directory, 'hashes.json'))
+        self.lock = threading.Lock()
+
+    def key(self, commands, inputs, statcache=None):
+        # Returns None if an input is missing, in which case the result cannot be cached
+        digests = {}
+        for filename in inputs:
+            digest = self.hashcache.digest(filename, statcache)
+            if not digest:
+                return None
+            digests[filename] = digest
+
+        return hashlib.sha256(json.dumps([commands, sorted(digests.items())]).encode('utf-8')).hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def restore(self, key, outputs):
+        entry = self.entry(key)
+        try:
+            with open(os.path.join(entry, 'manifest.json'), 'r') as manifestfile:
+                manifest = json.load(manifestfile)
+            if len(manifest['outputs']) != len(outputs):
+                return False
+
+            for index, filename in enumerate(outputs):
+                shutil.copyfile(os.path.join(entry, str(index)), filename)
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            return False
+
+        return True
+
+    def store(self, key, outputs):
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return
+
+        tempentry = entry + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        os.makedirs(tempentry)
+        size = 0
+        for index, filename in enumerate(outputs):
+            shutil.copyfile(filename, os.path.join(tempentry, str(index)))
+            size += os.path.getsize(filename)
+        with open(os.path.join(tempentry, 'manifest.json'), 'w') as manifestfile:
+            json.dump({ 'outputs': outputs, 'size': size }, manifestfile)
+
+        try:
+            os.rename(tempentry, entry)
+        except OSError:     # Stored by someone else in the meantime
+            shutil.rmtree(tempentry, ignore_errors=True)
+            return
+
+        total = self.add_size(size)
+        if total is None or total > self.maxsize:
+            self.evict()
+
+    def sizefile(self):
+        return os.path.join(self.directory, 'size')
+
+    def write_size(self, total):
+        tempname = self.sizefile() + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        with open(tempname, 'w') as sizefile:
+            sizefile.write(str(total))
+        os.replace(tempname, self.sizefile())
+
+    def add_size(self, size):
+        # Keeps a running total of the size of the cache, so that the cache only has to be
+        # looked through when it may have grown too large. Returns the new total, or None if
+        # the total is not known.
+        with self.lock, ArgumentHelper.lock(self.sizefile()):
+            try:
+                with open(self.sizefile(), 'r') as sizefile:
+                    total = int(sizefile.read()) + size
+            except (OSError, ValueError):
+                return None
+            self.write_size(total)
+        return total
+
+    def evict(self):
+        # Works out the size of the cache from the entries in it, removing the least recently
+        # used while it is too large, and records the size that is left
+        with self.lock, ArgumentHelper.lock(self.sizefile()):
+            entries = []
+            total = 0
+            for prefix in os.listdir(self.directory):
+                prefixdir = os.path.join(self.directory, prefix)
+                if len(prefix) != 2 or not os.path.isdir(prefixdir):
+                    continue
+                for key in os.listdir(prefixdir):
+                    entry = os.path.join(prefixdir, key)
+                    try:
+                        with open(os.path.join(entry, 'manifest.json'), 'r') as manifestfile:
+                            size = json.load(manifestfile)['size']
+                        entries.append((os.path.getmtime(entry), size, entry))
+                        total += size
+                    except (OSError, ValueError, KeyError):
+                        continue
+
+            entries.sort()
+            while total > self.maxsize and entries:
+                mtime, size, entry = entries.pop(0)
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+            self.write_size(total)
+
+    def save(self):
+        self.hashcache.save()
+
 class ArgumentRecorder(argparse.ArgumentParser):
 
+    def __init__(self, *args, **kwargs):
+        # Index of actions by destination, shared with argument groups, so that
+        # build_comments does not have to search the list of actions for each argument.
+        self._actionindex = {}
+        super().__init__(*args, **kwargs)
+
+    def _add_action(self, action):
+        # Every action passes through here, including those copied from parents
+        action = super()._add_action(action)
+        return _index_action(self._actionindex, action)
+
     def add_argument(self, *args, **kwargs):
         private = kwargs.pop('private', False)
         output = kwargs.pop('output', False)
@@ -103,110 +866,249 @@ class ArgumentRecorder(argparse.ArgumentParser):
         action.input = input
         action.output = output
         action.outvar = None
-        
+        return action
+
     def add_argument_group(self, *args, **kwargs):
         argument_group = super().add_argument_group(*args, **kwargs)
         argument_group.__class__ = _ArgumentGroup
+        argument_group._actionindex = self._actionindex
         return(argument_group)
 
     def build_comments(self, args, outfile=None):
-        comments = ArgumentHelper.separator(outfile)
-        
         inpipe = False
         outpipe = False
-        outvar = False
+        outvar = None
+        lines = []
         for argname, argval in vars(args).items():
+            action = self._actionindex.get(argname)
+            if not action:
+                continue
+
             if argval is None:
-                action = next((action for action in self._actions if action.dest == argname), None)
-                if action:
-                    if action.input:
-                        inpipe = True
-                    if action.output:
-                        outpipe = True
-                    if action.outvar:
-                        outvar = True
-                        
-        comments += '#' + ('<' if inpipe else '') + ('>' if outpipe else '') + (outvar if outvar else '') + ' ' + self.prog + '\n'
-        for argname, argval in vars(args).items():
-            action = next((action for action in self._actions if action.dest == argname), None)
-            if action and not action.private:
-                if action.option_strings:
-                    argspec = action.option_strings[-1]
-
-                prefix = '#' + ('<' if action.input else '>' if action.output else ' ') + '   '
-
-                if type(argval) == str or (sys.version_info[0] < 3 and type(argval) == unicode):
-                    comments += prefix + argspec + ' "' + argval + '"\n'
-                elif type(argval) == bool:
-                    if argval:
-                        comments += prefix + argspec + '\n'
-                elif type(argval) == list:
-                    if argval:
-                        for valitem in argval:
-                            if type(valitem) == str:
-                                comments += prefix + argspec + ' "' + valitem + '"\n'
-                            else:
-                                comments += prefix + argspec + ' ' + str(valitem) + '\n'
-                            argspec = ' ' * len(argspec)
-                    else:
-                        comments += prefix + argspec + '\n'
-                elif isinstance(argval, io.IOBase):
-                    comments += prefix + argspec + ' "' + argval.name + '"\n'
-                elif argval is not None:
-                    comments += prefix + argspec + ' ' + str(argval) + '\n'
+                if action.input:
+                    inpipe = True
+                if action.output:
+                    outpipe = True
+                if action.outvar:
+                    outvar = action.outvar
 
-        return comments
+            if action.private:
+                continue
 
-    def write_comments(self, args, dest, outfile=None, incomments=None, append=False, backup=None):
-        appendcomments = ''
-        if isinstance(dest, str):
-            if os.path.isfile(dest):
-                if backup:
-                    shutil.move(dest, dest + backup)
-                    if append:
-                        fileobject = open(dest + backup, 'r')
-                elif append:
-                    fileobject = open(dest, 'r')
-            else:
-                append = False
-        elif dest:
-            fileobject = dest
-        else:
-            fileobject = sys.stdout
-            append = False
+            argspec = action.option_strings[-1] if action.option_strings else ''
+            prefix = '#' + ('<' if action.input else '>' if action.output else ' ') + '   '
 
-        if append:
-            while True:
-                line = next(fileobject, None)
-                if line and line[:1] == '#':
-                    appendcomments += line
+            if type(argval) == str:
+                lines.append(prefix + argspec + ' "' + argval + '"\n')
+            elif type(argval) == bool:
+                if argval:
+                    lines.append(prefix + argspec + '\n')
+            elif type(argval) == list:
+                if argval:
+                    for valitem in argval:
+                        if type(valitem) == str:
+                            lines.append(prefix + argspec + ' "' + valitem + '"\n')
+                        else:
+                            lines.append(prefix + argspec + ' ' + str(valitem) + '\n')
+                        argspec = ' ' * len(argspec)
                 else:
-                    break
+                    lines.append(prefix + argspec + '\n')
+            elif isinstance(argval, io.IOBase):
+                lines.append(prefix + argspec + ' "' + argval.name + '"\n')
+            elif argval is not None:
+                lines.append(prefix + argspec + ' ' + str(argval) + '\n')
+
+        return ''.join([ArgumentHelper.separator(outfile),
+                        '#' + ('<' if inpipe else '') + ('>' if outpipe else '') + (outvar or '') + ' ' + self.prog + '\n']
+                       + lines)
 
+    def write_comments(self, args, dest, outfile=None, incomments=None, append=False, backup=None, sidecar=False, lock=False):
+        if not isinstance(dest, str):
+            comments = self.build_comments(args, outfile=outfile) + (incomments or '')
+            (dest or sys.stdout).write(comments)
+            return
+
+        # Build the new log in a temporary file beside the real file, if dest is a link, and
+        # move it into place, so that readers never see a partly written log. With lock set
+        # this is done while holding the lock, so that concurrent writers do not lose each
+        # other's comments.
+        dest = os.path.realpath(dest)
+        encoding = locale.getpreferredencoding(False)
+        tempname = dest + '.' + str(os.getpid())
+        with (ArgumentHelper.lock(dest) if lock else contextlib.nullcontext()):
+            comments = self.build_comments(args, outfile=outfile)
+            if append:
+                comments += ArgumentHelper.read_comments(dest)
+            if incomments:
+                comments += incomments
+            with open(tempname, 'w', encoding=encoding) as fileobject:
+                fileobject.write(comments)
+            ArgumentHelper.replace(tempname, dest, backup)
+            if sidecar:
+                ArgumentReplay.write_sidecar(dest, comments, encoding)
+
+    def append_log(self, args, dest, outfile=None, incomments=None, shard=False):
+        # Append-only logfile: the new entry is written to the end of the log in a single
+        # write, and its offset, length and time are appended to an index next to the log so
+        # that ArgumentReplay can read the entries newest first without rewriting anything.
+        # A new log starts with a marker line so that it is still read newest first without
+        # its index.
+        # With shard set each process appends to its own log beside dest without locking,
+        # and ArgumentReplay merges the shards by time when reading dest.
+        comments = self.build_comments(args, outfile=outfile) + (incomments or '')
+        data = comments.encode(locale.getpreferredencoding(False))
+        if shard:
+            dest = ArgumentReplay.shard_name(dest)
+
+        with (contextlib.nullcontext() if shard else ArgumentHelper.lock(dest)):
+            logfd = os.open(dest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                marker = ArgumentReplay.logmarker.encode() if not os.fstat(logfd).st_size else b''
+                os.write(logfd, marker + data)
+                end = os.lseek(logfd, 0, os.SEEK_CUR)
+            finally:
+                os.close(logfd)
+
+            with open(dest + ArgumentReplay.indexsuffix, 'a') as indexfile:
+                indexfile.write(str(end - len(data)) + ' ' + str(len(data)) + ' ' + str(time.time_ns()) + '\n')
+
+    @contextlib.contextmanager
+    def open_output(self, args, dest, outfile=None, incomments=None, sidecar=False, mode='w'):
+        # Context manager returning a file object with the comments already written to it,
+        # so that data can be streamed straight after the header.
+        if isinstance(dest, str):
+            fileobject = open(dest, mode)
+        else:
+            fileobject = dest or sys.stdout
+
+        comments = self.build_comments(args, outfile=outfile) + (incomments or '')
+        fileobject.write(comments)
+        try:
+            yield fileobject
+        finally:
             if isinstance(dest, str):
                 fileobject.close()
+                if sidecar:
+                    ArgumentReplay.write_sidecar(dest, comments, fileobject.encoding)
 
-        if isinstance(dest, str):
-            fileobject = open(dest, 'w')
+    def prepend_comments(self, args, dest, outfile=None, incomments=None, append=True, backup=None, sidecar=False, lock=False):
+        # Splice a new header onto an existing file, keeping its data. Unless append is set
+        # the existing comments are replaced. The data is copied with copy_file_range or
+        # sendfile where available, and the new file replaces the old one atomically.
+        if not os.path.isfile(dest):
+            return self.write_comments(args, dest, outfile=outfile, incomments=incomments, sidecar=sidecar, lock=lock)
 
-        fileobject.write(self.build_comments(args, outfile=outfile))
-        if append:
-            fileobject.write(appendcomments)
-        if incomments:
-            fileobject.write(incomments)
+        dest = os.path.realpath(dest)
+        encoding = locale.getpreferredencoding(False)
+        tempname = dest + '.' + str(os.getpid())
+        with (ArgumentHelper.lock(dest) if lock else contextlib.nullcontext()):
+            headersize = ArgumentHelper.header_size(dest)
+            datasize = os.path.getsize(dest) - headersize
+            comments = self.build_comments(args, outfile=outfile)
+            if append:
+                comments += ArgumentHelper.read_comments(dest)
+            if incomments:
+                comments += incomments
 
-        if isinstance(dest, str):
-            fileobject.close()
+            with open(dest, 'rb') as infile, open(tempname, 'wb') as outfile:
+                outfile.write(comments.encode(encoding))
+                outfile.flush()
+                ArgumentHelper.copy_range(infile, outfile, headersize, datasize)
+
+            ArgumentHelper.replace(tempname, dest, backup)
+            if sidecar:
+                ArgumentReplay.write_sidecar(dest, comments, encoding)
 
-    def replay_required(self, args):
+    def replay_required(self, args, hashcache=None, statcache=None):
         argsdict = vars(args)
-        earliestoutputtime = ArgumentHelper.earliest_timestamp([argsdict.get(action.dest) for action in self._actions if action.output])
-        latestinputtime    = ArgumentHelper.latest_timestamp  ([argsdict.get(action.dest) for action in self._actions if action.input])
+        if hashcache:
+            changed = hashcache.changed([argsdict.get(action.dest) for action in self._actions if action.input],
+                                        [argsdict.get(action.dest) for action in self._actions if action.output], statcache)
+            if changed is not None:
+                return changed
+
+        earliestoutputtime = ArgumentHelper.earliest_timestamp([argsdict.get(action.dest) for action in self._actions if action.output], statcache)
+        latestinputtime    = ArgumentHelper.latest_timestamp  ([argsdict.get(action.dest) for action in self._actions if action.input],  statcache)
 
         return latestinputtime is not None and ((not earliestoutputtime) or latestinputtime > earliestoutputtime)
 
+    def record_hashes(self, args, hashcache):
+        argsdict = vars(args)
+        hashcache.record([argsdict.get(action.dest) for action in self._actions if action.input],
+                         [argsdict.get(action.dest) for action in self._actions if action.output])
+        hashcache.save()
+
+class SubstitutionTemplate():
+
+    # A command item containing ${name} or ${name/pattern/string} substitutions, split up
+    # once so that it can be rendered cheaply against many sets of values.
+
+    patterns = {}
+
+    def __init__(self, item):
+        self.item = item
+        self.parts = []
+        self.names = set()
+        position = 0
+        for sub in ArgumentReplay.substexp.finditer(item):
+            if sub.start() > position:
+                self.parts.append(item[position:sub.start()])
+
+            name = sub.group('name')
+            replace = ArgumentReplay.replregexp.match(sub.group('modifier') or '')
+            if replace:
+                pattern = ArgumentReplay.unescapeexp.sub("\\1", replace.group('pattern'))
+                if pattern not in SubstitutionTemplate.patterns:
+                    SubstitutionTemplate.patterns[pattern] = re.compile(pattern)
+                string  = ArgumentReplay.unescapeexp.sub("\\1", replace.group('string'))
+                self.parts.append((name, SubstitutionTemplate.patterns[pattern], string, 0 if replace.group('replaceall') else 1))
+            else:
+                self.parts.append((name, None, None, 0))
+
+            self.names.add(name)
+            position = sub.end()
+
+        if position < len(item):
+            self.parts.append(item[position:])
+
+    def render(self, substitute):
+        if not self.names:
+            return self.item
+
+        result = []
+        for part in self.parts:
+            if type(part) == str:
+                result.append(part)
+            else:
+                name, pattern, string, count = part
+                value = substitute.get(name)
+                if value is None:
+                    raise RuntimeError("Missing substitution: " + name)
+                if pattern:
+                    value = pattern.sub(string, value, count=count)
+                result.append(value)
+
+        return ''.join(result)
+
+    def render_all(self, substitutes):
+        return [self.render(substitute) for substitute in substitutes]
+
+def _index_action(actionindex, action):
+    # Actions from a parser that is not an ArgumentRecorder are recorded as plain arguments
+    for attribute in ('private', 'input', 'output'):
+        if not hasattr(action, attribute):
+            setattr(action, attribute, False)
+    if not hasattr(action, 'outvar'):
+        action.outvar = None
+    actionindex.setdefault(action.dest, action)
+    return action
+
 class _ArgumentGroup(argparse._ArgumentGroup):
 
+    def _add_action(self, action):
+        action = super()._add_action(action)
+        return _index_action(self._actionindex, action)
+
     def add_argument(self, *args, **kwargs):
         private = kwargs.pop('private', False)
         output = kwargs.pop('output', False)
@@ -215,13 +1117,21 @@ class _ArgumentGroup(argparse._ArgumentGroup):
         action.private = private
         action.input = input
         action.output = output
+        action.outvar = None
+        return action
 
 class ArgumentReplay():
 
     commentregexp = re.compile(r"^##", re.UNICODE)
     headregexp = re.compile(r"^#+(?:\s+(?P<file>.+)\s+)?#+$", re.UNICODE)
     cmdregexp  = re.compile(r"^#(?P<inpipe>\<)?(?P<outpipe>\>(?P<outvar>\S+)?)?\s+(?P<cmd>[\S]+)", re.UNICODE)
-    argregexp  = re.compile(r"^#(?P<dependency>[<> ])\s*(?P<options>-[\w-]*)?\s*(?:(?P<quote>\"?)(?P<value>.*?)(?P<closequote>\"?))?$", re.UNICODE | re.DOTALL)
+    argregexp  = re.compile(r"^#(?P<dependency>[<> ])\s*(?P<options>-[\w-]*)?\s*(?P<quote>\"?)", re.UNICODE)
+    unescapeexp = re.compile(r"\\(.)", re.UNICODE)
+
+    sidecarsuffix = '.argrecord.json'
+    indexsuffix   = '.argrecord.idx'
+    shardsuffix   = '.shard'
+    logmarker     = '## argrecord append-only log\n'
 
     substexp   = re.compile(r"(\$\{(?P<name>\w+)(?P<modifier>[^\}]*)?\})", re.UNICODE)
     replregexp = re.compile(r"^/(?P<replaceall>/)?(?P<pattern>([^/\\]|\\/)+?)/(?P<string>.*)$", re.UNICODE)
@@ -230,6 +1140,7 @@ class ArgumentReplay():
         self.command = []
         self.inpipe = False
         self.outpipe = False
+        self.outvar = None
         self.inputs = []
         self.outputs = []
 
@@ -240,45 +1151,69 @@ class ArgumentReplay():
         else:
             fileobject = sys.stdin
 
+        self.parse(fileobject)
+
+    @staticmethod
+    def is_head(line):
+        # Only lines that both start and end with '#' can be headers, so avoid the regular
+        # expression for everything else.
+        return line[:2] == '##' and line.rstrip('\n')[-1:] == '#' and ArgumentReplay.headregexp.match(line) is not None
+
+    def parse(self, fileobject):
+        # Reads a single recipe, looking at each line once. Each line is classified by its
+        # leading characters so that at most one regular expression is run against it.
         line = next(fileobject, None)
         if not line:
             return
 
-        headmatch = ArgumentReplay.headregexp.match(line)
-        if headmatch:
+        if ArgumentReplay.is_head(line):
             line = next(fileobject, None)
 
         while line:
-            cmdmatch = ArgumentReplay.cmdregexp.match(line)
-            if cmdmatch:
-                self.command = [cmdmatch.group('cmd')]
-                self.inpipe  = cmdmatch.group('inpipe') == '<'
-                self.outvar  = cmdmatch.group('outvar')
-                self.outpipe = cmdmatch.group('outpipe') == '>' and not self.outvar
-                line = next(fileobject, None)
-                break
-            elif not ArgumentReplay.commentregexp.match(line):
-                line = None
-                break
+            if line[:2] != '##':
+                cmdmatch = ArgumentReplay.cmdregexp.match(line)
+                if cmdmatch:
+                    self.command = [cmdmatch.group('cmd')]
+                    self.inpipe  = cmdmatch.group('inpipe') == '<'
+                    self.outvar  = cmdmatch.group('outvar')
+                    self.outpipe = cmdmatch.group('outpipe') == '>' and not self.outvar
+                    line = next(fileobject, None)
+                    break
+                else:
+                    line = None
+                    break
 
             line = next(fileobject, None)
 
         while line:
-            argmatch = ArgumentReplay.argregexp.match(line.rstrip('\n'))
-            if not argmatch:
-                if ArgumentReplay.headregexp.match(line) or not ArgumentReplay.commentregexp.match(line):
+            if line[:1] != '#' or line[1:2] not in ('<', '>', ' '):
+                if line[:2] != '##' or ArgumentReplay.is_head(line):
                     break
             else:
-                if argmatch.group('quote') == '\"':
-                    while argmatch.group('closequote') != argmatch.group('quote'):
-                        line += next(fileobject, None)
-                        argmatch = ArgumentReplay.argregexp.match(line)
+                line = line.rstrip('\n')
+                argmatch = ArgumentReplay.argregexp.match(line)
+                value = line[argmatch.end():]
+                if value[-1:] == '"':
+                    value = value[:-1]
+                elif argmatch.group('quote'):
+                    # Quoted value continues until a line ending with a closing quote
+                    parts = [value]
+                    while True:
+                        line = next(fileobject, None)
+                        if line is None:
+                            break
+                        line = line.rstrip('\n')
+                        if line[-1:] == '"':
+                            parts.append(line[:-1])
+                            break
+                        parts.append(line)
+                    value = '\n'.join(parts)
+
+                if '\\' in value:
+                    value = ArgumentReplay.unescapeexp.sub("\\1", value)
 
                 dependency = argmatch.group('dependency')
                 options  = argmatch.group('options')
-                value = argmatch.group('value')
-                value = re.sub(r"\\(.)", "\\1", value)
-
                 if value:
                     if dependency == '<':
                         self.inputs.append(value)
@@ -292,8 +1227,251 @@ class ArgumentReplay():
 
             line = next(fileobject, None)
 
-    def earliest_output():
-        return ArgumentHelper.earliest_timestamp(self.outputs)
+    def to_dict(self):
+        return { 'command': self.command,
+                 'inpipe':  self.inpipe,
+                 'outpipe': self.outpipe,
+                 'outvar':  self.outvar,
+                 'inputs':  self.inputs,
+                 'outputs': self.outputs }
+
+    @classmethod
+    def from_dict(cls, recipe):
+        replay = cls.__new__(cls)
+        replay.command = recipe['command']
+        replay.inpipe  = recipe['inpipe']
+        replay.outpipe = recipe['outpipe']
+        replay.outvar  = recipe['outvar']
+        replay.inputs  = recipe['inputs']
+        replay.outputs = recipe['outputs']
+        return replay
+
+    @staticmethod
+    def write_sidecar(filename, comments, encoding=None):
+        # The sidecar holds the parsed recipes together with the size and digest of the
+        # header they were parsed from, so that it can be checked against the file.
+        header = comments.encode(encoding or 'utf-8')
+        sidecar = { 'time':    datetime.utcnow().isoformat(),
+                    'header':  { 'size': len(header), 'digest': hashlib.sha1(header).hexdigest() },
+                    'recipes': [replay.to_dict() for replay in ArgumentReplay.recipes(io.StringIO(comments))] }
+        sidecarname = filename + ArgumentReplay.sidecarsuffix
+        with open(sidecarname + '.' + str(os.getpid()), 'w') as sidecarfile:
+            json.dump(sidecar, sidecarfile)
+        os.replace(sidecarname + '.' + str(os.getpid()), sidecarname)
+
+    @staticmethod
+    def read_sidecar(filename):
+        # Returns None unless there is a sidecar that matches the header of the file.
+        sidecarname = filename + ArgumentReplay.sidecarsuffix
+        if not os.path.isfile(sidecarname):
+            return None
+
+        try:
+            with open(sidecarname, 'r') as sidecarfile:
+                sidecar = json.load(sidecarfile)
+            size   = sidecar['header']['size']
+            digest = sidecar['header']['digest']
+            with open(filename, 'rb') as fileobject:
+                header = fileobject.read(size + 1)
+        except (ValueError, KeyError, TypeError, OSError):
+            return None
+
+        if len(header) < size or header[size:] == b'#' or hashlib.sha1(header[:size]).hexdigest() != digest:
+            return None
+
+        return [ArgumentReplay.from_dict(recipe) for recipe in sidecar['recipes']]
+
+    @staticmethod
+    def shard_name(filename):
+        return filename + '.' + str(os.getpid()) + ArgumentReplay.shardsuffix
+
+    @staticmethod
+    def shards(filename):
+        return sorted(glob.glob(glob.escape(filename) + '.*' + ArgumentReplay.shardsuffix))
+
+    @staticmethod
+    def is_log(filename):
+        # Whether a trail is an append-only log, which is written oldest first
+        if os.path.isfile(filename + ArgumentReplay.indexsuffix) or ArgumentReplay.shards(filename):
+            return True
+        try:
+            with open(filename, 'rb') as fileobject:
+                return ArgumentReplay.log_start(fileobject) > 0
+        except OSError:
+            return False
+
+    @staticmethod
+    def log_start(fileobject):
+        # Offset of the first entry in an append-only log, after its marker if it has one.
+        # Logs written before the marker was added start with their first entry.
+        fileobject.seek(0)
+        marker = ArgumentReplay.logmarker.encode()
+        return len(marker) if fileobject.read(len(marker)) == marker else 0
+
+    @staticmethod
+    def read_index(filename, size, start=0):
+        # Returns the (offset, length, time) of each entry in an append-only log, oldest
+        # first, or None if there is no index or it does not account for the whole log
+        # from start. Indexes written before entries were timed have no times, which read
+        # as zero.
+        try:
+            with open(filename + ArgumentReplay.indexsuffix, 'r') as indexfile:
+                index = [(fields + [0])[:3] for fields in ([int(field) for field in line.split()] for line in indexfile)]
+        except (ValueError, OSError):
+            return None
+
+        # Writers to a shard do not take the lock, so their index lines may be out of order
+        index.sort()
+        end = start
+        for offset, length, entrytime in index:
+            if offset != end:
+                return None
+            end = offset + length
+
+        return index if end == size else None
+
+    @staticmethod
+    def reverse_lines(fileobject, size, start=0):
+        # Yields the lines of a binary file from start last first, reading it backwards in
+        # chunks.
+        position = size
+        buffer = b''
+        end = 0
+        while True:
+            newline = buffer.rfind(b'\n', 0, end - 1) if end > 1 else -1
+            if newline >= 0:
+                yield buffer[newline + 1:end]
+                end = newline + 1
+            elif position > start:
+                readsize = min(ArgumentHelper.chunksize, position - start)
+                position -= readsize
+                fileobject.seek(position)
+                buffer = fileobject.read(readsize) + buffer[:end]
+                end = len(buffer)
+            else:
+                if end > 0:
+                    yield buffer[:end]
+                break
+
+    @staticmethod
+    def timed_entries(filename):
+        # Generator yielding the entries of a single append-only log newest first, each with
+        # the time it was written. The index gives the entries directly; without a usable one
+        # the log is scanned backwards, split at header lines and timed by its modification.
+        encoding = locale.getpreferredencoding(False)
+        with open(filename, 'rb') as fileobject:
+            filestat = os.fstat(fileobject.fileno())
+            start = ArgumentReplay.log_start(fileobject)
+            index = ArgumentReplay.read_index(filename, filestat.st_size, start)
+            if index is not None:
+                for offset, length, entrytime in reversed(index):
+                    fileobject.seek(offset)
+                    yield entrytime, fileobject.read(length).decode(encoding)
+                return
+
+            lines = []
+            for line in ArgumentReplay.reverse_lines(fileobject, filestat.st_size, start):
+                lines.append(line)
+                if line[:2] == b'##' and ArgumentReplay.is_head(line.decode(encoding)):
+                    yield filestat.st_mtime_ns, b''.join(reversed(lines)).decode(encoding)
+                    lines = []
+            if lines:
+                yield filestat.st_mtime_ns, b''.join(reversed(lines)).decode(encoding)
+
+    @staticmethod
+    def merged_entries(filename):
+        # Entries of a log and all of its shards, newest first
+        sources = [ArgumentReplay.timed_entries(name) for name in [filename] + ArgumentReplay.shards(filename) if os.path.isfile(name)]
+        if len(sources) == 1:
+            return sources[0]
+        return heapq.merge(*sources, key=lambda timedentry: -timedentry[0])
+
+    @staticmethod
+    def log_entries(filename):
+        for entrytime, entry in ArgumentReplay.merged_entries(filename):
+            yield entry
+
+    @classmethod
+    def log_recipes(cls, filename):
+        for entry in ArgumentReplay.log_entries(filename):
+            yield from cls.recipes(io.StringIO(entry))
+
+    @staticmethod
+    def compact_log(filename):
+        # Rewrites an append-only log without the entries that have been superseded by a
+        # newer run of the same command writing the same outputs, folding in any shards, and
+        # rebuilds its index. Shards are removed afterwards, so should not be written to at
+        # the same time. Returns the number of entries dropped.
+        encoding = locale.getpreferredencoding(False)
+        logname = os.path.realpath(filename)  # The log may be a link; its index and shards are not
+        tempname = logname + '.' + str(os.getpid())
+        indextempname = filename + ArgumentReplay.indexsuffix + '.' + str(os.getpid())
+        with ArgumentHelper.lock(filename):
+            shards = ArgumentReplay.shards(filename)
+            kept = []
+            seen = set()
+            dropped = 0
+            for entrytime, entry in ArgumentReplay.merged_entries(filename):
+                replay = next(ArgumentReplay.recipes(io.StringIO(entry)), None)
+                if replay and replay.outputs:
+                    key = (replay.command[0], tuple(sorted(os.path.normpath(output) for output in replay.outputs)))
+                    if key in seen:
+                        dropped += 1
+                        continue
+                    seen.add(key)
+                kept.append((entrytime, entry))
+
+            offset = len(ArgumentReplay.logmarker.encode())
+            with open(tempname, 'wb') as logfile, open(indextempname, 'w') as indexfile:
+                logfile.write(ArgumentReplay.logmarker.encode())
+                for entrytime, entry in reversed(kept):
+                    data = entry.encode(encoding)
+                    logfile.write(data)
+                    indexfile.write(str(offset) + ' ' + str(len(data)) + ' ' + str(entrytime) + '\n')
+                    offset += len(data)
+
+            # Replace the index first: a new index does not match the old log, so a reader in
+            # between scans the log backwards rather than misreading it.
+            os.replace(indextempname, filename + ArgumentReplay.indexsuffix)
+            ArgumentHelper.replace(tempname, logname)
+            for shard in shards:
+                os.remove(shard)
+                if os.path.isfile(shard + ArgumentReplay.indexsuffix):
+                    os.remove(shard + ArgumentReplay.indexsuffix)
+
+        return dropped
+
+    @classmethod
+    def recipes(cls, source):
+        # Generator yielding the recipes in a trail one by one, newest first.
+        if isinstance(source, str):
+            if ArgumentReplay.is_log(source):
+                yield from cls.log_recipes(source)
+                return
+
+            sidecar = ArgumentReplay.read_sidecar(source)
+            if sidecar is not None:
+                yield from sidecar
+                return
+
+            fileobject = open(source, 'r')
+        elif source:
+            fileobject = source
+        else:
+            fileobject = sys.stdin
+
+        try:
+            while True:
+                replay = cls(fileobject)
+                if not replay.command:
+                    break
+                yield replay
+        finally:
+            if isinstance(source, str):
+                fileobject.close()
+
+    def earliest_output(self, statcache=None):
+        return ArgumentHelper.earliest_timestamp(self.outputs, statcache)
 
-    def latest_input():
-        return ArgumentHelper.latest_timestamp(self.inputs)
+    def latest_input(self, statcache=None):
+        return ArgumentHelper.latest_timestamp(self.inputs, statcache)
@@ -17,30 +17,32 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-from argrecord import ArgumentRecorder, ArgumentReplay, ArgumentHelper
+from argrecord import ArgumentRecorder, ArgumentReplay, ArgumentHelper, HashCache, StatCache, SubstitutionTemplate, BuildCache, PathResolver, FileWatcher
 import os
 import sys
 import re
 from datetime import datetime
 import subprocess
+import heapq
+import itertools
+import time
+import json
+import copy
+import codecs
+import locale
+import signal
+import importlib.util
+import threading
+import hmac
+import shutil
 
-try:
-    import gooey
-except ImportError:
-    pass
+# asyncio, concurrent.futures and gooey take longer to import than most replays take to
+# run, so they are only imported by the functions that need them.
 
-# Work out whether the user wants gooey before gooey has a chance to strip the argument
-gui = '--gui' in sys.argv
-if gui:
-    if 'gooey' not in sys.modules:
-        raise ImportError("You must install Gooey to use --gui\nTry 'pip install gooey'")
-
-    sys.argv.remove('--gui')
-
-def add_arguments(parser):
+def add_arguments(parser, gui=False):
     parser.description = "Replay command trails left by argrecord."
 
-    if 'gooey' in sys.modules and not gui: # Add --gui argument so it appears in command usage.
+    if not gui and importlib.util.find_spec('gooey'): # Add --gui argument so it appears in command usage.
         parser.add_argument('--gui', action='store_true', help='Open a window where arguments can be edited.')
 
     replaygroup = parser.add_argument_group('Replay')
@@ -51,7 +53,17 @@ def add_arguments(parser):
 
     replaygroup.add_argument('-f', '--force',   action='store_true', help='Replay even if input file is not older than its dependents.')
     replaygroup.add_argument(      '--dry-run', action='store_true', help='Print but do not execute command')
-    replaygroup.add_argument('-S', '--substitute', nargs='+', type=str, help='List of variable:value pairs for substitution')
+    replaygroup.add_argument(      '--plan',    action='store_true', private=True, help='Print every recipe that would be replayed, including those that depend on recipes that are out of date, with estimated times, without running anything.')
+    replaygroup.add_argument(      '--watch',   action='store_true', private=True, help='Keep running, replaying the recipes affected whenever a file they use changes.')
+    replaygroup.add_argument(      '--history', type=str, nargs='+', private=True, help='Files written by --stats-file from which to estimate how long each recipe will take.')
+    replaygroup.add_argument(      '--hash',    action='store_true', help='Replay only if the content of input files has changed, not just their timestamps.')
+    replaygroup.add_argument(      '--hash-cache', type=str, default=HashCache.default_filename, help='File in which to keep file content hashes.', private=True)
+    replaygroup.add_argument(      '--build-cache', type=str, private=True, help='Directory in which to keep the outputs of recipes, so that a recipe that has been run before with the same inputs can be restored instead of run.')
+    replaygroup.add_argument(      '--build-cache-size', type=int, default=1024, private=True, help='Maximum size of the build cache in megabytes.')
+    replaygroup.add_argument('-S', '--substitute', nargs='+', type=str, help='List of variable:value pairs for substitution; a value start..end replays once for each value in the range')
+    replaygroup.add_argument(      '--sweep',   type=str, help='File of variable:value pairs, with several values per variable, to replay for every combination of values')
+    replaygroup.add_argument(      '--sweep-jobs', type=int, default=1, private=True, help='Number of combinations of values to replay concurrently.')
+    replaygroup.add_argument(      '--sweep-dir', type=str, private=True, help='Directory in which to keep the output of each combination of values.')
     replaygroup.add_argument('-D', '--defaults', default='argreplay.def', type=str, help="File containing default substitute values")
     replaygroup.add_argument(      '--logfile',               type=str, help="Logfile for argreplay", private=True)
 
@@ -59,165 +71,1585 @@ def add_arguments(parser):
     advancedgroup.add_argument('-v', '--verbosity', type=int, default=1, private=True)
     advancedgroup.add_argument('-d', '--depth',     type=int, help='Depth of command history to replay, default is all.')
     advancedgroup.add_argument('-r', '--remove',   action='store_true', help='Remove input file before replaying.')
+    advancedgroup.add_argument(      '--separate', action='store_true', private=True, help='Replay each input file on its own rather than combining them, so that recipes they share are run for each.')
+    advancedgroup.add_argument(      '--compact',  action='store_true', private=True, help='Drop superseded entries from append-only logs before replaying.')
+    advancedgroup.add_argument('-j', '--jobs',      type=int, default=1, private=True, help='Number of independent recipes to replay concurrently.')
+    advancedgroup.add_argument(      '--profile', action='store_true', private=True, help='Print the time and resources used by each step, and the critical path.')
+    advancedgroup.add_argument(      '--stats-file', type=str, private=True, help='File in which to write the time and resources used by each step as JSON lines.')
+    advancedgroup.add_argument(      '--python-workers', type=int, default=0, private=True, help='Number of processes, started in advance, in which to run recipes that are Python scripts without starting a new Python interpreter for each.')
+    advancedgroup.add_argument(      '--python-preload', type=str, nargs='+', default=[], private=True, help='Modules for the Python worker processes to import in advance.')
+    advancedgroup.add_argument(      '--watch-debounce', type=float, default=0.2, private=True, help='Seconds without further changes to wait for before replaying after a change.')
+    advancedgroup.add_argument(      '--watch-interval', type=float, default=1.0, private=True, help='Seconds between looking at files that cannot be watched with inotify.')
+    advancedgroup.add_argument(      '--watch-poll', action='store_true', private=True, help='Look at files every interval rather than using inotify.')
+    advancedgroup.add_argument(      '--coordinator', type=str, private=True, help='Address as host:port on which to listen for workers started with argreplay-worker, which then run the recipes.')
+    advancedgroup.add_argument(      '--wait-workers', type=int, default=1, private=True, help='Number of workers to wait for before replaying.')
+    advancedgroup.add_argument(      '--worker-timeout', type=float, default=60, private=True, help='Seconds to wait for a worker to connect when none is connected, before giving up.')
+    advancedgroup.add_argument(      '--retries', type=int, default=2, private=True, help='Number of times a recipe run by a worker is run again if it fails or the worker is lost.')
+    advancedgroup.add_argument(      '--stat-threads', type=int, default=0, private=True, help='Number of threads with which to look up file timestamps, which can help on network filesystems.')
+
+def parse_gui_arguments(argstring):
+    try:
+        import gooey
+    except ImportError:
+        raise ImportError("You must install Gooey to use --gui\nTry 'pip install gooey'")
 
-if gui:
     @gooey.Gooey(optional_cols=1, tabbed_groups=True)
     def parse_arguments(argstring):
         parser = gooey.GooeyParser()
-        add_arguments(parser)
+        add_arguments(parser, gui=True)
         args = parser.parse_args(argstring)
         return args
-else:
-    def parse_arguments(argstring):
-        parser = ArgumentRecorder(fromfile_prefix_chars='@')
-        add_arguments(parser)
-        args, extra_args = parser.parse_known_args(argstring)
-        if '--ignore-gooey' in extra_args:   # Gooey adds '--ignore-gooey' when it calls the command
-            extra_args.remove('--ignore-gooey')
-
-        if args.logfile:
-            logfile = open(args.logfile, 'w')
-            parser.write_comments(args, logfile, incomments=ArgumentHelper.separator())
-            logfile.close()
-
-        args.extra_args = extra_args
-        args.substitute = { sub.split(':')[0]: sub.split(':')[1] for sub in args.substitute } if args.substitute else {}
-        return args
+
+    return parse_arguments(argstring)
+
+def parse_arguments(argstring):
+    parser = ArgumentRecorder(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    args, extra_args = parser.parse_known_args(argstring)
+    if '--ignore-gooey' in extra_args:   # Gooey adds '--ignore-gooey' when it calls the command
+        extra_args.remove('--ignore-gooey')
+
+    if args.logfile:
+        logfile = open(args.logfile, 'w')
+        parser.write_comments(args, logfile, incomments=ArgumentHelper.separator())
+        logfile.close()
+
+    args.extra_args = extra_args
+    args.substitute = { sub.split(':', 1)[0]: sub.split(':', 1)[1] for sub in args.substitute } if args.substitute else {}
+    return args
+
+class ReplayStep():
+
+    def __init__(self, pipestack, inputs, outputs, outvar):
+        self.pipestack = pipestack
+        self.inputs = inputs
+        self.outputs = outputs
+        self.outvar = outvar
+        self.dependencies = set()
+        self.dependents = set()
+        self.templates = [[SubstitutionTemplate(item) for item in command] for command in pipestack]
+        self.inputtemplates  = [SubstitutionTemplate(filename) for filename in inputs]
+        self.outputtemplates = [SubstitutionTemplate(filename) for filename in outputs]
+
+    def variables(self):
+        return set(name for command in self.templates for template in command for name in template.names)
+
+    def render(self, substitute):
+        return [[template.render(substitute) for template in command] for command in self.templates]
+
+    def render_all(self, substitutes):
+        return [self.render(substitute) for substitute in substitutes]
+
+    def files(self, substitute):
+        return ([template.render(substitute) for template in self.inputtemplates],
+                [template.render(substitute) for template in self.outputtemplates])
+
+    def key(self):
+        # Steps with the same key are the same recipe, wherever they were recorded
+        return (tuple(tuple(command) for command in self.pipestack), self.outvar, tuple(os.path.normpath(filename) for filename in self.outputs))
+
+    def copy(self):
+        # The same recipe without its place in a dependency graph
+        step = copy.copy(self)
+        step.dependencies = set()
+        step.dependents = set()
+        return step
+
+def read_steps(source, extra_args=[], depth=None):
+    curdepth = 0
+    replaystack = []
+    recipes = ArgumentReplay.recipes(source)
+    replay = next(recipes, None)
+    while replay:
+        pipestack = [replay.command + extra_args]
+        outputs = replay.outputs
+        inputs = replay.inputs
+        while replay and replay.inpipe:
+            replay = next(recipes, None)
+            inputs = replay.inputs if replay else []
+            if replay:
+                if replay.outpipe:
+                    pipestack.append(replay.command + extra_args)
+                else:
+                    replaystack.append(ReplayStep(pipestack, inputs, outputs, replay.outvar))
+                    pipestack = None
+                    break
+
+        if pipestack:
+            replaystack.append(ReplayStep(pipestack, inputs, outputs, replay.outvar if replay else None))
+
+        curdepth += 1
+        if depth and curdepth >= depth:
+            break
+
+        if replay:
+            replay = next(recipes, None)
+
+    # Recipes are recorded newest first, so replay them in reverse order
+    replaystack.reverse()
+    return replaystack
+
+def merge_steps(trails):
+    # Combines the steps of several trails into one list in which a recipe found in more
+    # than one trail appears once. Each recipe comes after every recipe that it depends on in
+    # any of the trails, and otherwise recipes stay in the order in which they were found.
+    merged = {}
+    dependencies = {}
+    for steps in trails:
+        for step, trailstep in zip(steps, build_dependencies([step.copy() for step in steps])):
+            key = step.key()
+            merged.setdefault(key, step)
+            dependencies.setdefault(key, set()).update(dependency.key() for dependency in trailstep.dependencies)
+
+    keys = list(merged)
+    order = { key: index for index, key in enumerate(keys) }
+    dependents = {}
+    for key in keys:
+        for dependency in dependencies[key]:
+            dependents.setdefault(dependency, []).append(key)
+    waiting = { key: len(dependencies[key]) for key in keys if dependencies[key] }
+    ready = [order[key] for key in keys if key not in waiting]
+    heapq.heapify(ready)
+    result = []
+    while ready or waiting:
+        if not ready:
+            # The trails disagree about which of some recipes comes first; take the one
+            # found first
+            key = min(waiting, key=order.get)
+            del waiting[key]
+            heapq.heappush(ready, order[key])
+
+        key = keys[heapq.heappop(ready)]
+        result.append(merged[key])
+        for dependent in dependents.get(key, []):
+            if dependent in waiting:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    del waiting[dependent]
+                    heapq.heappush(ready, order[dependent])
+
+    return result
+
+def build_dependencies(steps):
+    # A step depends on every earlier step that writes one of its inputs or outputs, reads
+    # one of its outputs, or captures an output variable that it substitutes.
+    # Variables are keyed as ${name} to keep them apart from filenames.
+    writers = {}
+    readers = {}
+    for step in steps:
+        for filename in step.inputs:
+            filename = os.path.normpath(filename)
+            if filename in writers:
+                step.dependencies.add(writers[filename])
+            readers.setdefault(filename, []).append(step)
+        for filename in step.outputs:
+            filename = os.path.normpath(filename)
+            if filename in writers:
+                step.dependencies.add(writers[filename])
+            step.dependencies.update(readers.pop(filename, []))
+            writers[filename] = step
+        for variable in step.variables():
+            variable = '${' + variable + '}'
+            if variable in writers:
+                step.dependencies.add(writers[variable])
+            readers.setdefault(variable, []).append(step)
+        if step.outvar:
+            variable = '${' + step.outvar + '}'
+            if variable in writers:
+                step.dependencies.add(writers[variable])
+            step.dependencies.update(readers.pop(variable, []))
+            writers[variable] = step
+
+        step.dependencies.discard(step)
+        for dependency in step.dependencies:
+            dependency.dependents.add(step)
+
+    return steps
+
+rangeregexp = re.compile(r"^(?P<start>-?\d+)\.\.(?P<end>-?\d+)$", re.UNICODE)
+
+def expand_value(value):
+    rangematch = rangeregexp.match(value)
+    if not rangematch:
+        return [value]
+
+    start = int(rangematch.group('start'))
+    end = int(rangematch.group('end'))
+    width = len(rangematch.group('start')) if rangematch.group('start')[:1] == '0' else 0
+    step = 1 if end >= start else -1
+    return [str(value).zfill(width) for value in range(start, end + step, step)]
+
+def expand_substitutes(substitute):
+    # Expand values of the form start..end, or lists of values, into one set of
+    # substitutions for each value, and for each combination of values if there are several.
+    names = list(substitute.keys())
+    valuelists = []
+    for name in names:
+        values = substitute[name] if isinstance(substitute[name], list) else [substitute[name]]
+        valuelists.append([expanded for value in values for expanded in expand_value(value)])
+
+    return [dict(zip(names, values)) for values in itertools.product(*valuelists)]
+
+def read_sweep(filename):
+    # A sweep file has a variable:value pair on each line, like a defaults file, but the
+    # same variable may appear on several lines to give it several values.
+    sweep = {}
+    with open(filename, 'r') as sweepfile:
+        for line in sweepfile.read().splitlines():
+            if line.strip():
+                sweep.setdefault(line.split(':', 1)[0], []).append(line.split(':', 1)[1])
+
+    return sweep
+
+def sweep_outputs(steps, names):
+    # Every combination is replayed in the same working directory, so a step that does
+    # something different for each combination must also write to different files. Values
+    # captured by steps that depend on the swept variables vary with them too, as does
+    # every step downstream of them. Returns the steps that vary, in the order of steps.
+    names = set(names)
+    while True:
+        varying = downstream(steps, [step for step in steps if (step.variables() | set(name for template in step.inputtemplates for name in template.names)) & names])
+        outvars = set(step.outvar for step in varying if step.outvar)
+        if outvars <= names:
+            break
+        names |= outvars
+
+    for step in varying:
+        if step.outputtemplates and not any(set(template.names) & names for template in step.outputtemplates):
+            raise RuntimeError("Output files " + ", ".join(step.outputs) + " would be written by every combination of values; use a swept variable or ${sweepdir} in their names.")
+
+    return varying
+
+def sweep_name(substitute, names):
+    return ','.join([name + '=' + substitute[name] for name in names]) or 'default'
+
+class SweepResult():
+
+    def __init__(self, substitute, directory=None):
+        self.substitute = substitute
+        self.directory = directory
+        self.executed = 0
+        self.failed = False
+        self.error = None
+        self.starttime = None
+        self.endtime = None
+
+    def duration(self):
+        return (self.endtime - self.starttime) if self.endtime else None
+
+sweepreplayer = None
+sweepsteps = None
+
+def sweep_init(replayer, steps):
+    # Runs in each worker process of a parallel sweep; the steps arrive with the process.
+    global sweepreplayer, sweepsteps
+    sys.stdin = open(os.devnull, 'r')
+    sweepreplayer = replayer
+    sweepsteps = steps
+
+def sweep_run(substitute, directory):
+    return sweepreplayer.sweep_one(sweepsteps, substitute, directory)
+
+class ReplayResult():
+
+    def __init__(self, step):
+        self.step = step
+        self.executed = False
+        self.returncode = None
+        self.returncodes = None
+        self.starttime = None
+        self.endtime = None
+        self.commands = None
+        self.restored = False
+        self.stattime = None
+        self.waittime = None
+        self.usertime = None
+        self.systemtime = None
+        self.maxrss = None
+        self.worker = None
+        self.attempts = None
+        self.output = None
+
+    def duration(self):
+        return (self.endtime - self.starttime) if self.executed and self.endtime else None
+
+    def stats(self, index):
+        return { 'type':       'step',
+                 'index':      index,
+                 'commands':   self.commands or self.step.pipestack,
+                 'executed':   self.executed,
+                 'restored':   self.restored,
+                 'returncode': self.returncode,
+                 'returncodes': self.returncodes,
+                 'start':      self.starttime.isoformat() if self.starttime else None,
+                 'stat':       self.stattime,
+                 'wait':       self.waittime,
+                 'user':       self.usertime,
+                 'system':     self.systemtime,
+                 'maxrss':     self.maxrss,
+                 'worker':     self.worker,
+                 'attempts':   self.attempts }
+
+def critical_path(steps, times):
+    # The chain of dependent steps with the longest total run time, which bounds the time
+    # a replay can take however many jobs are used. Steps are in dependency order, and times
+    # holds the run time of each.
+    finish = {}
+    previous = {}
+    for step in steps:
+        before = max(step.dependencies & finish.keys(), key=lambda dependency: finish[dependency], default=None)
+        finish[step] = (finish[before] if before else 0) + times.get(step, 0)
+        previous[step] = before
+
+    step = max(finish, key=lambda step: finish[step], default=None)
+    path = []
+    while step:
+        path.append(step)
+        step = previous[step]
+
+    path.reverse()
+    return path, sum(times.get(step, 0) for step in path)
+
+def profile_records(trail, loadtime, steps, results, walltime):
+    index = { step: position for position, step in enumerate(steps) }
+    path, pathtime = critical_path(steps, { result.step: result.waittime or 0 for result in results })
+    return ([{ 'type': 'trail', 'trail': trail, 'parse': loadtime, 'steps': len(steps) }]
+            + [result.stats(index[result.step]) for result in results]
+            + [{ 'type':               'summary',
+                 'trail':              trail,
+                 'wall':               walltime,
+                 'executed':           len([result for result in results if result.executed]),
+                 'critical_path':      [index[step] for step in path],
+                 'critical_path_time': pathtime }])
+
+def print_profile(records):
+    for record in records:
+        if record['type'] == 'trail':
+            print("Parsed " + record['trail'] + " (" + str(record['steps']) + " steps) in %.3fs" % record['parse'], file=sys.stderr)
+        elif record['type'] == 'step' and record['executed']:
+            print("Step %d: wait %.3fs" % (record['index'], record['wait'] or 0)
+                  + (", user %.3fs, system %.3fs, maxrss %dkB" % (record['user'], record['system'], record['maxrss']) if record['user'] is not None else "")
+                  + (" on " + record['worker'] + (" after " + str(record['attempts']) + " attempts" if record['attempts'] > 1 else "") if record.get('worker') else "")
+                  + ", exit " + str(record['returncode']) + ": " + ' | '.join([' '.join(command) for command in reversed(record['commands'])]), file=sys.stderr)
+        elif record['type'] == 'summary':
+            print("Replayed " + str(record['executed']) + " steps in %.3fs" % record['wall'], file=sys.stderr)
+            print("Critical path: " + ' -> '.join([str(index) for index in record['critical_path']]) + " taking %.3fs" % record['critical_path_time'], file=sys.stderr)
+        elif record['type'] == 'worker':
+            print("Worker " + record['worker'] + ": " + str(record['jobs']) + " run, " + str(record['failures']) + " failed, busy %.3fs" % record['busy']
+                  + ("" if record['connected'] else ", disconnected"), file=sys.stderr)
+
+def read_durations(filenames):
+    # The run time of each command line from the step records of earlier --stats-file
+    # output, the latest successful run of a command line taking precedence
+    durations = {}
+    for filename in filenames:
+        with open(filename, 'r') as statsfile:
+            for line in statsfile:
+                record = json.loads(line)
+                if record.get('type') == 'step' and record['executed'] and record['wait'] is not None and not record['returncode']:
+                    durations[json.dumps(record['commands'])] = record['wait']
+
+    return durations
+
+def plan_records(steps, planned, stale, substitute, durations):
+    # The steps that will be rebuilt, in the order they would be run, with the reason and
+    # the time each took when it was last run, followed by the estimated total and critical
+    # path. Steps that only depend on a captured variable are shown unsubstituted.
+    index = { step: position for position, step in enumerate(steps) }
+    records = []
+    times = {}
+    for step in planned:
+        try:
+            commands = step.render(substitute)
+            outputs = step.files(substitute)[1]
+        except RuntimeError:
+            commands = step.pipestack
+            outputs = step.outputs
+        times[step] = durations.get(json.dumps(commands))
+        records.append({ 'type':     'plan',
+                         'index':    index[step],
+                         'reason':   'stale' if step in stale else 'upstream',
+                         'commands': commands,
+                         'outputs':  outputs,
+                         'estimate': times[step] })
+
+    path, pathtime = critical_path(planned, { step: time or 0 for step, time in times.items() })
+    records.append({ 'type':               'plan_summary',
+                     'steps':              len(planned),
+                     'estimate':           sum(time for time in times.values() if time is not None),
+                     'unknown':            len([time for time in times.values() if time is None]),
+                     'critical_path':      [index[step] for step in path],
+                     'critical_path_time': pathtime })
+    return records
+
+def print_plan(records):
+    for record in records:
+        if record['type'] == 'plan':
+            print("Step %d (%s, %s): " % (record['index'], record['reason'], "%.3fs" % record['estimate'] if record['estimate'] is not None else "unknown time")
+                  + ' | '.join([' '.join(command) for command in reversed(record['commands'])]))
+        elif record['type'] == 'plan_summary':
+            print(str(record['steps']) + " steps to rebuild, estimated %.3fs" % record['estimate']
+                  + (" plus " + str(record['unknown']) + " steps of unknown time" if record['unknown'] else ""))
+            if record['critical_path']:
+                print("Critical path: " + ' -> '.join([str(index) for index in record['critical_path']]) + " taking %.3fs" % record['critical_path_time'])
+
+def downstream(steps, selected):
+    # The selected steps and every step that depends on them, directly or not, in the order
+    # of steps
+    affected = set(selected)
+    for step in steps:
+        if step.dependencies & affected:
+            affected.add(step)
+    return [step for step in steps if step in affected]
+
+def stream_fd(fileobject):
+    # File descriptor through which a child can use fileobject directly, or None if its
+    # data has to be copied by us, as when it has been replaced by an in-memory stream.
+    try:
+        fileobject.flush()
+        return fileobject.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def reap(process):
+    # Waits for a process, using wait4 where available to get the resources it used
+    if hasattr(os, 'wait4'):
+        pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return usage
+
+    process.wait()
+    return None
+
+async def pump(pipe, fileobject=None, chunks=None):
+    # Copies a child's output as it arrives, either to fileobject or into chunks, so that no
+    # pipe is ever left full while we wait for something else.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=ArgumentHelper.chunksize)
+    transport, protocol = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    decoder = None
+    try:
+        while True:
+            data = await reader.read(ArgumentHelper.chunksize)
+            if not data:
+                break
+            if chunks is not None:
+                chunks.append(data)
+            elif hasattr(fileobject, 'buffer'):
+                fileobject.buffer.write(data)
+                fileobject.buffer.flush()
+            else:
+                decoder = decoder or codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors='replace')
+                fileobject.write(decoder.decode(data))
+    finally:
+        transport.close()
+
+def spawn_pipeline(commands, capture=False, executables={}, cwd=None):
+    # Starts the stages of a pipeline, first stage first, joined by OS pipes so that the data
+    # passes directly from one to the next. Output that cannot go straight to our standard
+    # output or error, or is to be captured, is left in a pipe on the process. Commands found
+    # in executables are run from the paths given there rather than looked up again. With cwd
+    # the stages are run in that directory.
+    stdin  = stream_fd(sys.stdin)
+    stdout = None if capture else stream_fd(sys.stdout)
+    stderr = stream_fd(sys.stderr)
+    processes = []
+    previous = subprocess.DEVNULL if stdin is None else stdin
+    try:
+        for index, command in enumerate(commands):
+            last = index == len(commands) - 1
+            process = subprocess.Popen(command,
+                                       executable=executables.get(command[0]),
+                                       stdin=previous,
+                                       stdout=subprocess.PIPE if not last or stdout is None else stdout,
+                                       stderr=subprocess.PIPE if stderr is None else stderr,
+                                       cwd=cwd)
+            if processes:
+                # Only the next stage may hold the read end, so that a stage whose reader
+                # exits gets SIGPIPE rather than blocking for ever.
+                processes[-1].stdout.close()
+            processes.append(process)
+            previous = process.stdout
+    except OSError:
+        if processes and processes[-1].stdout:
+            processes[-1].stdout.close()
+        for process in processes:
+            if process.stderr:
+                process.stderr.close()
+            reap(process)
+        raise
+
+    return processes
+
+async def run_pipeline(commands, capture=False, executables={}, cwd=None):
+    # Runs a pipeline, streaming the output of the last stage, or capturing it without limit
+    # if capture is set, while every stage is reaped concurrently. Returns the exit code and
+    # resources used by each stage, and the captured output.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    processes = spawn_pipeline(commands, capture, executables, cwd)
+    chunks = []
+    pumps = [pump(process.stderr, sys.stderr) for process in processes if process.stderr]
+    if processes[-1].stdout:
+        pumps.append(pump(processes[-1].stdout, sys.stdout, chunks if capture else None))
+
+    outcome = await asyncio.gather(*[loop.run_in_executor(None, reap, process) for process in processes], *pumps)
+    output = b''.join(chunks).decode(locale.getpreferredencoding(False)) if capture else None
+    return [process.returncode for process in processes], outcome[:len(processes)], output
+
+def run_commands(commands, capture=False, executables={}, cwd=None):
+    # Runs a pipeline, only using asyncio when some of its output has to pass through us.
+    # Otherwise nothing can block on us, so the stages are simply waited for in turn.
+    if capture or stream_fd(sys.stdout) is None or stream_fd(sys.stderr) is None:
+        import asyncio
+        return asyncio.run(run_pipeline(commands, capture, executables, cwd))
+
+    processes = spawn_pipeline(commands, capture, executables, cwd)
+    usages = [reap(process) for process in processes]
+    return [process.returncode for process in processes], usages, None
+
+pythonregexp = re.compile(r"^python(?P<major>\d)?(\.\d+)?$", re.UNICODE)
+
+def same_interpreter(interpreter, resolver=None):
+    # Whether an interpreter, as named in a command or #! line, is the one we are running.
+    # It must be the same file in the same directory, since the directory of the interpreter
+    # decides which virtual environment, and so which packages, it uses.
+    if os.sep not in interpreter:
+        interpreter = resolver.lookup(interpreter) if resolver else shutil.which(interpreter)
+    if not interpreter:
+        return False
+    try:
+        return (os.path.realpath(os.path.dirname(os.path.abspath(interpreter))) == os.path.realpath(os.path.dirname(os.path.abspath(sys.executable)))
+                and os.path.samefile(interpreter, sys.executable))
+    except OSError:
+        return False
+
+def python_job(command, executable=None, resolver=None):
+    # What a Python worker needs to run a command itself: whether it runs a script or a
+    # module, which one and its arguments. None unless the command runs a Python script or
+    # module with the interpreter we are running and no interpreter options.
+    match = pythonregexp.match(os.path.basename(command[0]))
+    if match:
+        if not same_interpreter(executable or command[0], resolver):
+            return None
+        if len(command) > 2 and command[1] == '-m':
+            return ('module', command[2], command[3:])
+        if len(command) > 1 and command[1][:1] != '-' and os.path.isfile(command[1]):
+            return ('script', command[1], command[2:])
+        return None
+
+    script = executable or command[0]
+    try:
+        with open(script, 'rb') as scriptfile:
+            shebang = scriptfile.readline(256).decode('utf-8', 'replace').split()
+    except OSError:
+        return None
+    if not shebang or shebang[0][:2] != '#!':
+        return None
+
+    interpreter = [shebang[0][2:]] + shebang[1:]
+    if os.path.basename(interpreter[0]) == 'env' and len(interpreter) > 1:
+        interpreter = interpreter[1:]
+    if not interpreter[0] and len(interpreter) > 1:    # As in '#! /usr/bin/python'
+        interpreter = interpreter[1:]
+    if len(interpreter) != 1 or not pythonregexp.match(os.path.basename(interpreter[0])) or not same_interpreter(interpreter[0], resolver):
+        return None
+    return ('script', script, command[1:])
+
+def python_child(job, fds, environ, cwd):
+    # Runs a job in a process forked from a worker, with the standard input, output and
+    # error it was given, in the way that the Python interpreter would run it
+    import atexit
+    import runpy
+    import traceback
+    kind, target, arguments = job
+    try:
+        for fd, stdfd in zip(fds, (0, 1, 2)):
+            if fd != stdfd:
+                os.dup2(fd, stdfd)
+                os.close(fd)
+        # The streams inherited from the worker may not be on these descriptors, and the
+        # exit handlers inherited from the host are not the script's to run
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', errors='backslashreplace', closefd=False)
+        atexit._clear()
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        sys.argv = [target] + arguments
+        if kind == 'module':
+            runpy.run_module(target, run_name='__main__', alter_sys=True)
+        else:
+            sys.path[0] = os.path.dirname(os.path.abspath(target))
+            runpy.run_path(target, run_name='__main__')
+        code = 0
+    except SystemExit as exit:
+        if exit.code is None or isinstance(exit.code, int):
+            code = exit.code or 0
+        else:
+            print(exit.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    try:
+        # os._exit skips the script's exit handlers, so run them first
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+def python_worker(connection, preload):
+    # Imports the modules that jobs are likely to need, then forks a fresh process for each
+    # job it is sent, so that jobs do not affect each other but start with those modules
+    # already imported. Replies with the exit code and resources used by each job.
+    import importlib
+    import pickle
+    import socket
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    while True:
+        try:
+            message, fds, flags, address = socket.recv_fds(connection, 1 << 20, 3)
+        except OSError:
+            break
+        if not message:
+            break
+
+        job, environ, cwd = pickle.loads(message)
+        pid = os.fork()
+        if pid == 0:
+            connection.close()
+            python_child(job, fds, environ, cwd)
+        for fd in fds:
+            os.close(fd)
+        pid, status, usage = os.wait4(pid, 0)
+        connection.sendall(pickle.dumps((os.waitstatus_to_exitcode(status), usage)))
+
+class PythonPool():
+
+    # Processes forked before a run starts, that run Python scripts and modules without
+    # starting a new interpreter and importing everything again for each one.
+
+    def __init__(self, workers, preload=[]):
+        self.workers = workers
+        self.preload = preload
+        self.idle = []
+        self.pids = []
+        self.alive = 0
+        self.condition = threading.Condition()
+
+    def __getstate__(self):
+        # Workers belong to the process that forked them, so a copy starts its own
+        return { 'workers': self.workers, 'preload': self.preload }
+
+    def __setstate__(self, state):
+        self.__init__(state['workers'], state['preload'])
+
+    def start(self):
+        # Forks the workers unless they are already running. This should be done before any
+        # threads are started, as forking a process with threads is not safe.
+        import socket
+        if self.pids or not hasattr(os, 'fork') or not hasattr(socket, 'send_fds'):
+            return
+
+        for worker in range(self.workers):
+            parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    parent.close()
+                    for connection in self.idle:
+                        connection.close()
+                    python_worker(child, self.preload)
+                finally:
+                    os._exit(0)
+            child.close()
+            self.pids.append(pid)
+            self.idle.append(parent)
+            self.alive += 1
+
+    def run(self, job, fds):
+        # Runs a job in the first free worker, with fds as its standard input, output and
+        # error. Returns its exit code and resources used, or None if there are no workers
+        # or the worker died, in which case the job has to be run some other way.
+        import pickle
+        import socket
+        with self.condition:
+            while not self.idle:
+                if not self.alive:
+                    return None
+                self.condition.wait()
+            connection = self.idle.pop()
+
+        try:
+            socket.send_fds(connection, [pickle.dumps((job, dict(os.environ), os.getcwd()))], fds)
+            reply = connection.recv(1 << 16)
+        except OSError:
+            reply = None
+
+        with self.condition:
+            if reply:
+                self.idle.append(connection)
+            else:
+                connection.close()
+                self.alive -= 1
+            self.condition.notify_all()
+
+        return pickle.loads(reply) if reply else None
+
+    def close(self):
+        with self.condition:
+            for connection in self.idle:
+                connection.close()
+            for pid in self.pids:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.idle = []
+            self.pids = []
+            self.alive = 0
+
+def pipeline_returncode(returncodes):
+    # The exit code of the last stage unless that succeeded and an earlier stage failed,
+    # other than by being cut off when a later stage stopped reading.
+    for returncode in reversed(returncodes):
+        if returncode and returncode != -signal.SIGPIPE:
+            return returncode
+    return returncodes[-1]
+
+# Recipes can be run by workers on other hosts, started with argreplay-worker, that connect
+# to a coordinator in argreplay over TCP. Messages in both directions are lines of JSON. The
+# coordinator decides which recipes need to be run and sends their commands, already
+# substituted, to workers with spare capacity; the workers send back the exit codes,
+# resources used and any captured output. The coordinator and workers must share a
+# filesystem, since files themselves are never sent. Whoever can connect to the coordinator
+# can ask it for commands, so with a token a worker must present the same token to be sent
+# any. Messages are not encrypted, so the coordinator should only listen on a trusted network.
+
+tokenvariable = 'ARGREPLAY_TOKEN'
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return (host or 'localhost', int(port))
+
+def send_message(connection, lock, message):
+    with lock:
+        connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+def run_worker(address, capacity=1, name=None, verbosity=1, timeout=60, token=None):
+    # Connects to a coordinator, trying for up to timeout seconds, and runs the commands it
+    # sends, up to capacity at once, until the coordinator has finished with it. Commands are
+    # run in the coordinator's directory if it exists here. Returns the number of commands run.
+    import socket
+    name = name or socket.gethostname() + ':' + str(os.getpid())
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connection = socket.create_connection(address)
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+    lock = threading.Lock()
+    slots = threading.Semaphore(capacity)
+    threads = []
+    count = 0
+    def run(message):
+        starttime = time.perf_counter()
+        try:
+            returncodes, usages, output = run_commands(message['commands'], message['capture'], cwd=message['cwd'] if os.path.isdir(message['cwd']) else None)
+        except OSError as error:
+            if verbosity >= 1:
+                print("Error running " + message['commands'][0][0] + ": " + str(error), file=sys.stderr)
+            returncodes, usages, output = [127], [None], None
+        try:
+            send_message(connection, lock, { 'type':        'result',
+                                             'id':          message['id'],
+                                             'returncodes': returncodes,
+                                             'usages':      [list(usage) if usage else None for usage in usages],
+                                             'output':      output,
+                                             'wait':        time.perf_counter() - starttime })
+        except OSError:
+            pass
+        finally:
+            slots.release()
+
+    try:
+        send_message(connection, lock, { 'type': 'hello', 'name': name, 'capacity': capacity, 'token': token })
+        for line in connection.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+            if message['type'] == 'exit':
+                break
+            elif message['type'] == 'run':
+                slots.acquire()
+                if verbosity >= 1:
+                    print("Executing: " + ' | '.join([' '.join(command) for command in message['commands']]), file=sys.stderr)
+                threads = [thread for thread in threads if thread.is_alive()]
+                threads.append(threading.Thread(target=run, args=(message,)))
+                threads[-1].start()
+                count += 1
+    finally:
+        for thread in threads:
+            thread.join()
+        connection.close()
+
+    return count
+
+def worker_main(argstring=None):
+    parser = argparse.ArgumentParser(description="Run recipes sent by argreplay --coordinator.")
+    parser.add_argument('address', type=str, help='Address of the coordinator as host:port.')
+    parser.add_argument('-c', '--capacity', type=int, default=os.cpu_count() or 1, help='Number of recipes to run at once, default is the number of processors.')
+    parser.add_argument('-n', '--name',     type=str, help='Name by which the coordinator reports this worker, default is host:pid.')
+    parser.add_argument('-t', '--timeout',  type=float, default=60, help='Seconds to keep trying to connect to the coordinator.')
+    parser.add_argument('-v', '--verbosity', type=int, default=1)
+    args = parser.parse_args(argstring)
+    # The token is taken from the environment so that it does not appear in process listings
+    run_worker(parse_address(args.address), args.capacity, args.name, args.verbosity, args.timeout, os.environ.get(tokenvariable))
+
+class RemoteWorker():
+
+    def __init__(self, connection, name, capacity):
+        self.connection = connection
+        self.name = name
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.running = {}
+        self.alive = True
+        self.jobs = 0
+        self.failures = 0
+        self.busy = 0.0
+
+class Coordinator():
+
+    # Listens for workers and hands them commands to run, never more at once than a worker's
+    # capacity. A command that fails, or whose worker is lost, is run again up to retries
+    # times, on a worker that has not tried it yet if one is free. If no worker is connected
+    # for timeout seconds while a command is waiting to be run, the run is given up.
+
+    def __init__(self, address=('localhost', 0), retries=2, verbosity=1, timeout=60, token=None):
+        import socket
+        self.server = socket.create_server(address)
+        self.address = self.server.getsockname()[:2]
+        self.retries = retries
+        self.verbosity = verbosity
+        self.timeout = timeout
+        self.token = token
+        self.workers = []
+        self.nextid = 0
+        self.closing = False
+        self.condition = threading.Condition()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, peer = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        # Reads what one worker sends, starting with its name and capacity. If the worker is
+        # lost, the commands it was running are given no reply so that they are run again.
+        worker = None
+        try:
+            for line in connection.makefile('r', encoding='utf-8'):
+                message = json.loads(line)
+                if message['type'] == 'hello':
+                    if self.token is not None and not hmac.compare_digest(str(message.get('token')).encode('utf-8'), self.token.encode('utf-8')):
+                        if self.verbosity >= 1:
+                            print("Rejected worker " + str(message.get('name')) + " with the wrong token", file=sys.stderr)
+                        break
+                    worker = RemoteWorker(connection, message['name'], max(message['capacity'], 1))
+                    with self.condition:
+                        self.workers.append(worker)
+                        self.condition.notify_all()
+                    if self.verbosity >= 1:
+                        print("Worker " + worker.name + " connected with capacity " + str(worker.capacity), file=sys.stderr)
+                elif message['type'] == 'result' and worker:
+                    with self.condition:
+                        pending = worker.running.pop(message['id'], None)
+                        worker.busy += message['wait']
+                        self.condition.notify_all()
+                    if pending:
+                        pending[1] = message
+                        pending[0].set()
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            connection.close()
+            if worker:
+                with self.condition:
+                    worker.alive = False
+                    lost = list(worker.running.values())
+                    worker.running = {}
+                    self.condition.notify_all()
+                for pending in lost:
+                    pending[0].set()
+                if self.verbosity >= 1 and not self.closing:
+                    print("Worker " + worker.name + " disconnected", file=sys.stderr)
+
+    def wait_workers(self, count, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len([worker for worker in self.workers if worker.alive]) >= count, timeout):
+                raise RuntimeError("Only " + str(len([worker for worker in self.workers if worker.alive])) + " of " + str(count) + " workers connected.")
+
+    def capacity(self):
+        with self.condition:
+            return sum(worker.capacity for worker in self.workers if worker.alive)
+
+    def dispatch(self, message, tried):
+        # Sends a command to the least busy worker with spare capacity, waiting for one if
+        # need be, and waits for its reply, which is None if the worker was lost.
+        with self.condition:
+            deadline = None
+            while True:
+                free = [worker for worker in self.workers if worker.alive and len(worker.running) < worker.capacity]
+                if free:
+                    break
+                if any(worker.alive for worker in self.workers):
+                    deadline = None
+                    self.condition.wait()
+                    continue
+
+                deadline = deadline or time.monotonic() + self.timeout
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError("No workers connected for " + str(self.timeout) + " seconds.")
+                self.condition.wait(remaining)
+            worker = min(free, key=lambda worker: (worker.name in tried, len(worker.running) / worker.capacity))
+            message = message | { 'id': self.nextid }
+            self.nextid += 1
+            pending = [threading.Event(), None]
+            worker.running[message['id']] = pending
+
+        try:
+            send_message(worker.connection, worker.lock, message)
+        except OSError:
+            with self.condition:
+                worker.running.pop(message['id'], None)
+                self.condition.notify_all()
+            pending[0].set()
+            try:
+                worker.connection.shutdown(2)
+            except OSError:
+                pass
+
+        pending[0].wait()
+        return worker, pending[1]
+
+    def run(self, commands, capture=False):
+        # Runs commands on a worker as run_commands would run them here, returning the same,
+        # followed by the name of the last worker to run them and the number of attempts.
+        import resource
+        message = { 'type': 'run', 'commands': commands, 'capture': capture, 'cwd': os.getcwd() }
+        tried = set()
+        attempts = 0
+        while True:
+            attempts += 1
+            worker, reply = self.dispatch(message, tried)
+            tried.add(worker.name)
+            outcome = (reply['returncodes'], [resource.struct_rusage(usage) if usage else None for usage in reply['usages']], reply['output']) if reply else None
+            failed = outcome is None or pipeline_returncode(outcome[0])
+            with self.condition:
+                worker.jobs += 1
+                if failed:
+                    worker.failures += 1
+
+            if not failed or attempts > self.retries:
+                if outcome is None:
+                    raise RuntimeError("Lost worker " + worker.name + " while running: " + ' | '.join([' '.join(command) for command in commands]))
+                return outcome, worker.name, attempts
+
+            if self.verbosity >= 1:
+                print(("Worker " + worker.name + " was lost" if outcome is None else "Failed on " + worker.name) + ", retrying: " + ' | '.join([' '.join(command) for command in commands]), file=sys.stderr)
+
+    def summary(self):
+        with self.condition:
+            return [{ 'type':      'worker',
+                      'worker':    worker.name,
+                      'capacity':  worker.capacity,
+                      'jobs':      worker.jobs,
+                      'failures':  worker.failures,
+                      'busy':      worker.busy,
+                      'connected': worker.alive } for worker in self.workers]
+
+    def close(self):
+        self.closing = True
+        with self.condition:
+            workers = [worker for worker in self.workers if worker.alive]
+        for worker in workers:
+            try:
+                send_message(worker.connection, worker.lock, { 'type': 'exit' })
+            except OSError:
+                pass
+        try:
+            self.server.shutdown(2)
+        except OSError:
+            pass
+        self.server.close()
+
+class Replayer():
+
+    # Keeps parsed trails between replays, so that a long-running process can replay the
+    # same trails many times without starting argreplay or parsing them again.
+
+    def __init__(self, substitute={}, extra_args=[], depth=None, force=False, dry_run=False, jobs=1, verbosity=1, hashcache=None, stat_threads=0, profile=False, buildcache=None, python_workers=0, python_preload=[], coordinator=None):
+        self.substitute = substitute
+        self.extra_args = extra_args
+        self.depth = depth
+        self.force = force
+        self.dry_run = dry_run
+        self.jobs = jobs
+        self.verbosity = verbosity
+        self.hashcache = hashcache
+        self.stat_threads = stat_threads
+        self.profile = profile
+        self.buildcache = buildcache
+        self.pythonpool = PythonPool(python_workers, python_preload) if python_workers else None
+        self.coordinator = coordinator
+        self.statcache = None
+        self.resolver = PathResolver()
+        self.executables = {}
+        self.trails = {}
+        self.loadtimes = {}
+
+    def find(self, filename):
+        if ArgumentReplay.shards(filename):
+            return filename
+        candidate = self.resolver.lookup(filename, executable=False, current=True)
+        if candidate:
+            return candidate
+
+        raise RuntimeError("File not found: " + filename)
+
+    def load_all(self, filenames):
+        # One dependency graph for several trails, in which a recipe found in more than one
+        # of them is only run once
+        return build_dependencies(merge_steps([[step.copy() for step in self.load(filename)] for filename in filenames]))
+
+    def resolve(self, steps, substitute):
+        # Looks up every command that may be run on PATH once, before anything is run, so
+        # that a missing command is reported straight away along with any others that are
+        # missing, rather than after the steps before it have been run. Commands run by a
+        # coordinator are looked up by its workers instead.
+        if self.coordinator:
+            return
+        names = [command[0] for step in self.rebuilds(steps, substitute) for command in step.pipestack if '${' not in command[0]]
+        self.executables, missing = self.resolver.resolve_all(names)
+        if missing:
+            if not self.dry_run:
+                raise RuntimeError("Commands not found: " + ', '.join(missing))
+            if self.verbosity >= 1:
+                print("Commands not found: " + ', '.join(missing), file=sys.stderr)
+
+    def load(self, filename):
+        candidate = self.find(filename)
+        # Shards of an append-only log change without the log itself changing
+        key = []
+        for name in [candidate] + ArgumentReplay.shards(candidate):
+            if os.path.isfile(name):
+                stat = os.stat(name)
+                key.append((stat.st_mtime_ns, stat.st_size))
+        key = tuple(key)
+        trail = self.trails.get(candidate)
+        if not trail or trail[0] != key:
+            starttime = time.perf_counter()
+            trail = (key, build_dependencies(read_steps(candidate, self.extra_args, self.depth)))
+            self.trails[candidate] = trail
+            self.loadtimes[candidate] = time.perf_counter() - starttime
+
+        return trail[1]
+
+    def stale(self, step, substitute={}):
+        # Returns whether the step needs to be run, and whether the hash cache knew about it
+        if self.force:
+            return True, None
+
+        try:
+            inputs, outputs = step.files(substitute)
+        except RuntimeError:    # Depends on a variable that has not been captured yet
+            return True, None
+
+        changed = self.hashcache.changed(inputs, outputs, self.statcache) if self.hashcache else None
+        if changed is not None:
+            return changed, changed
+
+        latestinput    = ArgumentHelper.latest_timestamp(inputs, self.statcache)
+        earliestoutput = ArgumentHelper.earliest_timestamp(outputs, self.statcache)
+        return (not latestinput) or (not earliestoutput) or (latestinput > earliestoutput), None
+
+    def start_run(self, steps, substitute):
+        # Each run gets a fresh stat cache, filled in one go for every file the steps mention
+        self.statcache = StatCache(self.stat_threads)
+        filelist = []
+        for step in steps:
+            try:
+                inputs, outputs = step.files(substitute)
+            except RuntimeError:
+                continue
+            filelist += inputs
+            filelist += outputs
+        self.statcache.prefetch(filelist)
+
+    def rebuilds(self, steps, substitute):
+        # The steps that are out of date now, and every step downstream of them, since those
+        # will be out of date once the steps they depend on have been run
+        return downstream(steps, [step for step in steps if self.stale(step, substitute)[0]])
+
+    def plan(self, steps, substitute=None):
+        substitute = self.substitute | (substitute or {})
+        self.start_run(steps, substitute)
+        return self.rebuilds(steps, substitute)
+
+    def estimate(self, steps, substitute=None, durations={}):
+        # Plan records for the steps that will be rebuilt, without running anything
+        substitute = self.substitute | (substitute or {})
+        self.start_run(steps, substitute)
+        stale = set(step for step in steps if self.stale(step, substitute)[0])
+        return plan_records(steps, downstream(steps, stale), stale, substitute, durations)
+
+    def run_step(self, step, substitute):
+        result = ReplayResult(step)
+        starttime = time.perf_counter()
+        execute, changed = self.stale(step, substitute)
+        result.stattime = time.perf_counter() - starttime
+        if not execute:
+            if self.hashcache and changed is None and not self.dry_run:
+                # Up to date by timestamp, so take the current content as the baseline
+                self.hashcache.record(*step.files(substitute), self.statcache)
+            return result
+
+        result.starttime = datetime.now()
+        result.commands = step.render(substitute)
+        inputs, outputs = step.files(substitute)
+        cachekey = None
+        if self.buildcache and outputs and not step.outvar and not self.dry_run:
+            cachekey = self.buildcache.key(result.commands, inputs, self.statcache)
+            if cachekey and self.buildcache.restore(cachekey, outputs):
+                if self.verbosity >= 1:
+                    print("Restored from cache: " + ' '.join(outputs), file=sys.stderr)
+                result.restored = True
+                result.returncode = 0
+                result.endtime = datetime.now()
+                self.statcache.invalidate(outputs)
+                if self.hashcache:
+                    self.hashcache.record(inputs, outputs, self.statcache)
+                return result
+
+        result.executed = True
+        outvar = step.outvar
+        if self.verbosity >= 2:
+            print ("Piping: ", str(len(step.pipestack)), " commands:", file=sys.stderr)
+        for commandready in reversed(result.commands):
+            if self.verbosity >= 1:
+                print("Executing: " + ' '.join([item if not any(delimiter in item for delimiter in [' ',';']) else '"' + item + '"' for item in commandready]), file=sys.stderr)
+                if outvar:
+                    print("   Output piped to variable " + outvar, file=sys.stderr)
+
+        if not self.dry_run:
+            starttime = time.perf_counter()
+            commands = list(reversed(result.commands))
+            outcome = None
+            if self.coordinator:
+                outcome, result.worker, result.attempts = self.coordinator.run(commands, bool(outvar))
+            elif self.pythonpool and len(commands) == 1 and not outvar:
+                outcome = self.run_python(commands[0])
+            result.returncodes, usages, output = outcome or run_commands(commands, capture=bool(outvar), executables=self.executables)
+            result.waittime = time.perf_counter() - starttime
+            if self.profile and all(usages):
+                result.usertime = sum(usage.ru_utime for usage in usages)
+                result.systemtime = sum(usage.ru_stime for usage in usages)
+                result.maxrss = max(usage.ru_maxrss for usage in usages)
+            if outvar:
+                substitute[outvar] = output
+                result.output = output
+            result.returncode = pipeline_returncode(result.returncodes)
+            if self.verbosity >= 1 and result.returncode and len(result.returncodes) > 1:
+                print("Pipeline exit codes: " + ' '.join(str(returncode) for returncode in result.returncodes), file=sys.stderr)
+            self.statcache.invalidate(outputs)
+            if not result.returncode and self.hashcache:
+                self.hashcache.record(inputs, outputs, self.statcache)
+            if not result.returncode and cachekey and all(ArgumentHelper.file_stat(filename, self.statcache) for filename in outputs):
+                self.buildcache.store(cachekey, outputs)
+
+        result.endtime = datetime.now()
+        return result
+
+    def run_python(self, command):
+        # Runs a command in the Python worker pool if it runs a Python script and our standard
+        # input and output can be handed to it, returning None if it has to be run otherwise
+        job = python_job(command, self.executables.get(command[0]), self.resolver)
+        fds = [stream_fd(sys.stdin), stream_fd(sys.stdout), stream_fd(sys.stderr)]
+        if job is None or None in fds:
+            return None
+
+        reply = self.pythonpool.run(job, fds)
+        if reply is None:
+            return None
+        returncode, usage = reply
+        return [returncode], [usage], None
+
+    def close(self):
+        if self.pythonpool:
+            self.pythonpool.close()
+
+    def execute(self, steps, substitute=None):
+        # Run steps as soon as all of their dependencies have completed, like make -j. Ready
+        # steps are started in trail order so that a single job replays exactly as before.
+        # Stops starting new steps once one has failed, and returns a result for each step
+        # that was considered.
+        substitute = self.substitute | (substitute or {})
+        self.start_run(steps, substitute)
+        self.resolver.refresh()
+        self.resolve(steps, substitute)
+        if self.pythonpool and not self.dry_run:
+            self.pythonpool.start()
+        jobs = max(self.jobs or 1, self.coordinator.capacity() if self.coordinator else 1)
+        order = { step: index for index, step in enumerate(steps) }
+        waiting = { step: len(step.dependencies & order.keys()) for step in steps }
+        ready = [order[step] for step in steps if not waiting[step]]
+        heapq.heapify(ready)
+        running = {}
+        results = []
+        error = None
+        failed = False
+        def complete(step, result):
+            # Records the result of a step, making its dependents ready if it succeeded
+            results.append(result)
+            if result.returncode:
+                return True
+
+            for dependent in step.dependents:
+                if dependent in waiting:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        heapq.heappush(ready, order[dependent])
+            return False
+
+        try:
+            if jobs == 1:
+                # One step at a time needs no threads
+                while ready and not failed:
+                    step = steps[heapq.heappop(ready)]
+                    failed = complete(step, self.run_step(step, substitute))
+            else:
+                import concurrent.futures
+                with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                    while ready or running:
+                        while ready and len(running) < jobs and not error and not failed:
+                            step = steps[heapq.heappop(ready)]
+                            running[executor.submit(self.run_step, step, substitute)] = step
+
+                        if not running:
+                            break
+
+                        finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in finished:
+                            step = running.pop(future)
+                            if future.exception():
+                                error = error or future.exception()
+                            elif complete(step, future.result()):
+                                failed = True
+        finally:
+            if self.hashcache:
+                self.hashcache.save()
+            if self.buildcache:
+                self.buildcache.save()
+
+        if error:
+            raise error
+
+        return results
+
+    def replay(self, filename, substitute=None):
+        return self.execute(self.load(filename), substitute)
+
+    def watch(self, filenames, substitute=None, debounce=0.2, interval=1.0, inotify=True, stop=None):
+        # Replays the trails, then keeps them loaded and waits for the files their recipes
+        # read or write to change, replaying only the recipes that use the changed files and
+        # those downstream of them. Yields the changed files, the steps considered and their
+        # results after each replay. A change to a trail reloads it. Files written by a replay
+        # are taken as seen, so that they do not set off another. Variables captured by one
+        # replay are kept for the next, in which the steps capturing them may not be run.
+        substitute = self.substitute | (substitute or {})
+        candidates = [self.find(filename) for filename in filenames]
+        watcher = FileWatcher(interval, inotify)
+        def watch_files(steps, values):
+            # The steps using each file, watching every file; files named by captured
+            # variables can only be watched once the variables are known
+            users = {}
+            for step in steps:
+                try:
+                    inputs, outputs = step.files(values)
+                except RuntimeError:    # Depends on a variable not captured yet
+                    continue
+                for filename in inputs + outputs:
+                    if filename:
+                        users.setdefault(os.path.normpath(filename), []).append(step)
+            watcher.watch(list(users) + candidates)
+            return users
+
+        try:
+            changed = []
+            steps = None
+            affected = None
+            captured = {}
+            while True:
+                if steps is None or set(changed) & set(os.path.normpath(candidate) for candidate in candidates):
+                    steps = self.load(candidates[0]) if len(candidates) == 1 else self.load_all(candidates)
+                    captured = {}
+                    users = watch_files(steps, substitute)
+
+                if affected is None:
+                    affected = steps
+                else:
+                    if self.verbosity >= 1:
+                        print("Changed: " + ' '.join(changed), file=sys.stderr)
+                    affected = downstream(steps, [step for filename in changed for step in users.get(filename, [])])
+                    # Steps capturing a variable that has not been captured yet must be run too
+                    missing = set(variable for step in affected for variable in step.variables()) - substitute.keys() - captured.keys()
+                    if missing:
+                        affected = downstream(steps, set(affected) | set(step for step in steps if step.outvar in missing))
+                results = self.execute(affected, substitute | captured) if affected else []
+                for result in results:
+                    if result.executed and result.step.outvar and not result.returncode:
+                        captured[result.step.outvar] = result.output
+
+                if any(result.step.outvar for result in results if result.executed):
+                    users = watch_files(steps, substitute | captured)
+
+                written = list(candidates)
+                for result in results:
+                    if result.executed:
+                        try:
+                            written += result.step.files(substitute | captured)[1]
+                        except RuntimeError:
+                            pass
+                watcher.seen(written)
+                yield changed, affected, results
+
+                changed = watcher.wait(debounce, stop)
+                if not changed:
+                    return
+        finally:
+            watcher.close()
+
+    def sweep_one(self, steps, substitute, directory=None):
+        # Replay the steps with one combination of values. With a directory, standard output
+        # and error go to files there and the directory is available as ${sweepdir}.
+        result = SweepResult(substitute, directory)
+        stdout = sys.stdout
+        stderr = sys.stderr
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            substitute = substitute | { 'sweepdir': directory }
+            sys.stdout = open(os.path.join(directory, 'stdout.txt'), 'w')
+            sys.stderr = open(os.path.join(directory, 'stderr.txt'), 'w')
+
+        result.starttime = datetime.now()
+        try:
+            results = self.execute(steps, substitute)
+            result.executed = len([replayresult for replayresult in results if replayresult.executed])
+            result.failed = any(replayresult.returncode for replayresult in results)
+        except Exception as error:
+            result.error = str(error)
+            result.failed = True
+        finally:
+            result.endtime = datetime.now()
+            if directory:
+                sys.stdout.close()
+                sys.stderr.close()
+                sys.stdout = stdout
+                sys.stderr = stderr
+
+        return result
+
+    def sweep(self, steps, substitutes, jobs=1, directory=None):
+        # Replay the steps once for each set of substitutions, in a pool of worker processes
+        # if jobs is more than one. Each combination gets its own directory under the given one.
+        names = [name for name in substitutes[0] if len(set(substitute[name] for substitute in substitutes)) > 1]
+        directories = [os.path.join(directory, sweep_name(substitute, names)) if directory else None for substitute in substitutes]
+        if len(substitutes) > 1:
+            varying = sweep_outputs(steps, set(names) | ({ 'sweepdir' } if directory else set()))
+            shared = [step for step in steps if step not in varying]
+            if shared:
+                # Steps that are the same for every combination are replayed once beforehand,
+                # and the values they capture are passed on to each combination.
+                results = self.execute(shared, substitutes[0])
+                if any(result.returncode for result in results):
+                    raise RuntimeError("Error running the recipes shared by every combination of values.")
+                captured = { result.step.outvar: result.output for result in results if result.executed and result.step.outvar }
+                substitutes = [substitute | captured for substitute in substitutes]
+            steps = varying
+        if jobs > 1 and len(substitutes) > 1:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=sweep_init, initargs=(self, steps)) as executor:
+                return list(executor.map(sweep_run, substitutes, directories))
+        else:
+            return [self.sweep_one(steps, substitute, sweepdirectory) for substitute, sweepdirectory in zip(substitutes, directories)]
 
 def main(argstring=None):
-    args = parse_arguments(argstring)
-    
+    if '--gui' in (sys.argv if argstring is None else argstring):
+        # Take --gui out before Gooey sees it, since Gooey runs the command again with the
+        # arguments from its window
+        if argstring is None:
+            sys.argv.remove('--gui')
+        else:
+            argstring = [arg for arg in argstring if arg != '--gui']
+        args = parse_gui_arguments(argstring)
+    else:
+        args = parse_arguments(argstring)
+
     defaultsubstitute = {}
     if args.defaults:
         try:
             with open(args.defaults, 'r') as defaultsfile:
-                defaultsubstitute = { sub.split(':')[0]: sub.split(':')[1] for sub in defaultsfile.read().splitlines() }
+                defaultsubstitute = { sub.split(':', 1)[0]: sub.split(':', 1)[1] for sub in defaultsfile.read().splitlines() }
         except FileNotFoundError:
             pass
 
+    hashcache = HashCache(args.hash_cache) if args.hash else None
+    substitutes = expand_substitutes(defaultsubstitute | args.substitute | (read_sweep(args.sweep) if args.sweep else {}))
+    replayer = Replayer(substitute=substitutes[0],
+                        extra_args=args.extra_args,
+                        depth=args.depth,
+                        force=args.force,
+                        dry_run=args.dry_run,
+                        jobs=args.jobs,
+                        verbosity=args.verbosity,
+                        hashcache=hashcache,
+                        stat_threads=args.stat_threads,
+                        profile=args.profile or bool(args.stats_file),
+                        buildcache=BuildCache(args.build_cache, args.build_cache_size << 20, hashcache) if args.build_cache else None,
+                        python_workers=args.python_workers,
+                        python_preload=args.python_preload)
+
+    if args.watch and (len(substitutes) > 1 or args.sweep_dir or args.separate or args.plan or args.remove):
+        raise RuntimeError("--watch cannot be used with more than one combination of values, --sweep-dir, --separate, --plan or --remove.")
+
+    if args.coordinator and args.sweep_jobs > 1:
+        raise RuntimeError("--coordinator cannot be used with --sweep-jobs.")
+
+    durations = read_durations(args.history) if args.history else {}
+    statsfile = open(args.stats_file, 'w') if args.stats_file else None
+
     if not isinstance(args.input_file, list):    # Gooey can't handle args.input_file as list
         args.input_file = [args.input_file]
 
+    candidates = []
     for infilename in args.input_file:
         if args.verbosity >= 1:
             print("Replaying " + infilename, file=sys.stderr)
 
-        path = os.environ['PATH'].split(':')
-        path.insert(0, '')
-        candidate = None
-        for dirname in path:
-            candidate = os.path.join(dirname, infilename)
-            if os.path.isfile(candidate):
-                break
-            else:
-                candidate = None
-
-        if not candidate:
-            raise RuntimeError("File not found: " + infilename)
-
-        infile = open(candidate, 'r')
-
-        curdepth = 0
-        replaystack = []
-        replay = ArgumentReplay(infile)
-        while replay.command:
-            pipestack = [replay.command + args.extra_args]
-            outputs = replay.outputs
-            inputs = replay.inputs
-            while replay.command and replay.inpipe:
-                replay = ArgumentReplay(infile)
-                inputs = replay.inputs
-                if replay.command:
-                    if replay.outpipe:
-                        pipestack.append(replay.command + args.extra_args)
-                    else:
-                        replaystack.append((pipestack, inputs, outputs, replay.outvar))
-                        pipestack = None
-                        break
+        candidate = replayer.find(infilename)
+        if args.compact and ArgumentReplay.is_log(candidate):
+            dropped = ArgumentReplay.compact_log(candidate)
+            if args.verbosity >= 2:
+                print("Dropped " + str(dropped) + " superseded entries from " + candidate, file=sys.stderr)
+        candidates.append(candidate)
 
-            if pipestack:
-                replaystack.append((pipestack, inputs, outputs, replay.outvar))
-            else:
-                pipestack = [replay.command + args.extra_args]
-                outputs = replay.outputs
-                inputs = replay.inputs
+    coordinator = None
+    if args.coordinator and not (args.plan or args.dry_run):
+        coordinator = Coordinator(parse_address(args.coordinator), args.retries, args.verbosity, args.worker_timeout, os.environ.get(tokenvariable))
+        replayer.coordinator = coordinator
+        if args.verbosity >= 1:
+            print("Waiting for " + str(args.wait_workers) + " workers on " + ':'.join(str(part) for part in coordinator.address), file=sys.stderr)
+        coordinator.wait_workers(args.wait_workers, args.worker_timeout)
 
-            curdepth += 1
-            if args.depth and curdepth >= args.depth:
-                break
+    # Unless asked to replay them one by one, the trails are combined so that recipes they
+    # share are only run once
+    groups = [[candidate] for candidate in candidates] if args.separate or len(candidates) == 1 else [candidates]
 
-            if replay.command:
-                replay = ArgumentReplay(infile)
+    try:
+        for group in groups:
+            steps = replayer.load(group[0]) if len(group) == 1 else replayer.load_all(group)
+            trailname = ', '.join(group)
 
-        if replaystack:
-            (pipestack, inputs, outputs, outvar) = replaystack.pop()
-        else:
-            pipestack = None
-
-        substitute = defaultsubstitute | args.substitute
-        while pipestack:
-            execute = args.force
-            if not execute:
-                latestinput    = ArgumentHelper.latest_timestamp(inputs)
-                earliestoutput = ArgumentHelper.earliest_timestamp(outputs)
-                execute = (not latestinput) or (not earliestoutput) or (latestinput > earliestoutput)
-
-            if execute:
-                if args.remove:
-                    os.args.remove(infilename)
-
-                process = None
-                if args.verbosity >= 2:
-                    print ("Piping: ", str(len(pipestack)), " commands:", file=sys.stderr)
-                while len(pipestack):
-                    commandraw   = pipestack.pop()
-                    commandready = []
-                    for item in commandraw:
-                        subs = ArgumentReplay.substexp.finditer(item)
-                        for sub in subs:
-                            subname = sub.group('name')
-                            subval = substitute.get(subname)
-                            modifier = sub.group('modifier')
-                            if modifier is not None:
-                                replace = ArgumentReplay.replregexp.match(modifier)
-                                if replace:
-                                    replaceall = replace.group('replaceall')
-                                    pattern = replace.group('pattern')
-                                    pattern = re.sub(r"\\(.)", "\\1", pattern)
-                                    string  = replace.group('string')
-                                    string  = re.sub(r"\\(.)", "\\1", string)
-                                    
-                                    subval = re.sub(pattern, string, subval, count=1 if replaceall else 0)
-
-                            if subval is None:
-                                raise RuntimeError("Missing substitution: " + subname)
-
-                            item = item.replace(sub.group(0), subval)
-                            
-                        commandready.append(item)
-
-                    if args.verbosity >= 1:
-                        print("Executing: " + ' '.join([item if not any(delimiter in item for delimiter in [' ',';']) else '"' + item + '"' for item in commandready]), file=sys.stderr)
-                        if outvar:
-                            print("   Output piped to variable " + outvar, file=sys.stderr)
-
-
-                    if not args.dry_run:
-                        process = subprocess.Popen(commandready, text=True,
-                                                   stdout=subprocess.PIPE if len(pipestack) or outvar else sys.stdout,
-                                                   stdin=process.stdout if process else sys.stdin,
-                                                   stderr=sys.stderr)
-                if not args.dry_run:
-                    process.wait()
-                    if outvar:
-                        substitute[outvar] = process.stdout.read()
-                    if process.returncode:
-                        raise RuntimeError("Error running script.")
-
-            if replaystack:
-                (pipestack, inputs, outputs, outvar) = replaystack.pop()
+            if args.remove and not args.plan:
+                for candidate in group:
+                    for filename in [candidate] + ArgumentReplay.shards(candidate):
+                        for suffix in ('', ArgumentReplay.sidecarsuffix, ArgumentReplay.indexsuffix):
+                            if os.path.isfile(filename + suffix):
+                                os.remove(filename + suffix)
+
+            if args.plan:
+                names = [name for name in substitutes[0] if len(set(substitute[name] for substitute in substitutes)) > 1]
+                for substitute in substitutes:
+                    if names:
+                        print("Plan for " + sweep_name(substitute, names) + ":")
+                    records = replayer.estimate(steps, substitute, durations)
+                    print_plan(records)
+                    if statsfile:
+                        for record in records:
+                            statsfile.write(json.dumps(record) + '\n')
+            elif args.watch:
+                try:
+                    for changed, watchsteps, results in replayer.watch(group, substitutes[0], args.watch_debounce, args.watch_interval, not args.watch_poll):
+                        if args.profile or statsfile:
+                            times = [result for result in results if result.executed and result.endtime]
+                            walltime = (max(result.endtime for result in times) - min(result.starttime for result in times)).total_seconds() if times else 0
+                            records = profile_records(trailname, sum(replayer.loadtimes.get(candidate, 0) for candidate in group), watchsteps, results, walltime)
+                            if args.profile:
+                                print_profile(records)
+                            if statsfile:
+                                for record in records:
+                                    statsfile.write(json.dumps(record) + '\n')
+                                statsfile.flush()
+                        if any(result.returncode for result in results):
+                            print("Error running script.", file=sys.stderr)
+                except KeyboardInterrupt:
+                    pass
+            elif len(substitutes) == 1 and not args.sweep_dir:
+                starttime = time.perf_counter()
+                results = replayer.execute(steps, substitutes[0])
+                if args.profile or statsfile:
+                    records = profile_records(trailname, sum(replayer.loadtimes.get(candidate, 0) for candidate in group), steps, results, time.perf_counter() - starttime)
+                    if args.profile:
+                        print_profile(records)
+                    if statsfile:
+                        for record in records:
+                            statsfile.write(json.dumps(record) + '\n')
+
+                if any(result.returncode for result in results):
+                    raise RuntimeError("Error running script.")
             else:
-                pipestack = None
+                names = [name for name in substitutes[0] if len(set(substitute[name] for substitute in substitutes)) > 1]
+                sweepresults = replayer.sweep(steps, substitutes, args.sweep_jobs, args.sweep_dir)
+                if args.verbosity >= 1:
+                    for sweepresult in sweepresults:
+                        print(sweep_name(sweepresult.substitute, names) + ": " + str(sweepresult.executed) + " run, "
+                              + ("failed" + (" (" + sweepresult.error + ")" if sweepresult.error else "") if sweepresult.failed else "succeeded")
+                              + " in " + str(sweepresult.duration()), file=sys.stderr)
+                    print(str(len(sweepresults)) + " combinations, " + str(len([sweepresult for sweepresult in sweepresults if sweepresult.failed])) + " failed", file=sys.stderr)
+
+                if any(sweepresult.failed for sweepresult in sweepresults):
+                    raise RuntimeError("Error running script.")
+    finally:
+        if coordinator:
+            if args.profile:
+                print_profile(coordinator.summary())
+            if statsfile:
+                for record in coordinator.summary():
+                    statsfile.write(json.dumps(record) + '\n')
+            coordinator.close()
+        replayer.close()
+        if statsfile:
+            statsfile.close()
 
 if __name__ == '__main__':
     main()
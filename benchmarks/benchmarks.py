@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks of the recording and replay hot paths. The classes follow the conventions of
+# airspeed velocity: setup is run first, then each time_ method is timed and each peakmem_
+# method measured, once for every value in params. Running this file runs them without
+# asv, and can save the results and compare them with results saved earlier.
+
+import argrecord
+import argrecord.argreplay
+import argparse
+import asyncio
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+def synthetic_trail(recipes, pipedepth=1):
+    # A trail of recipes, newest first, in which each reads the file the one before wrote.
+    # With pipedepth the recipes are joined in pipes of that many commands.
+    lines = []
+    for index in reversed(range(recipes)):
+        stage = index % pipedepth
+        inpipe  = stage > 0
+        outpipe = stage < pipedepth - 1 and index < recipes - 1
+        lines.append(argrecord.ArgumentHelper.separator())
+        lines.append('#' + ('<' if inpipe else '') + ('>' if outpipe else '') + ' tool' + str(index % 10) + '\n')
+        lines.append('#    --threshold 0.' + str(index) + '\n')
+        lines.append('#    --label "recipe ' + str(index) + '"\n')
+        lines.append('#    --verbose\n')
+        if not inpipe:
+            lines.append('#<   --input "data/f' + str(index) + '.txt"\n')
+        if not outpipe:
+            lines.append('#>   --output "data/f' + str(index + 1) + '.txt"\n')
+
+    return ''.join(lines)
+
+class BuildComments():
+
+    params = [10, 100, 500]
+
+    def setup(self, options):
+        self.parser = argrecord.ArgumentRecorder('tool')
+        argv = []
+        for index in range(options):
+            kind = index % 5
+            name = '--option' + str(index)
+            if kind == 0:
+                self.parser.add_argument(name, type=str)
+                argv += [name, 'value ' + str(index)]
+            elif kind == 1:
+                self.parser.add_argument(name, type=int)
+                argv += [name, str(index)]
+            elif kind == 2:
+                self.parser.add_argument(name, action='store_true')
+                argv += [name]
+            elif kind == 3:
+                self.parser.add_argument(name, type=str, nargs='+', input=True)
+                argv += [name, 'in' + str(index) + 'a.txt', 'in' + str(index) + 'b.txt']
+            else:
+                self.parser.add_argument(name, type=str, output=True)
+                argv += [name, 'out' + str(index) + '.txt']
+        self.args = self.parser.parse_args(argv)
+
+    def time_build_comments(self, options):
+        self.parser.build_comments(self.args)
+
+class ParseTrail():
+
+    params = [10000, 100000]
+
+    def setup(self, recipes):
+        self.trail = synthetic_trail(recipes)
+
+    def time_recipes(self, recipes):
+        for replay in argrecord.ArgumentReplay.recipes(io.StringIO(self.trail)):
+            pass
+
+    def peakmem_recipes(self, recipes):
+        list(argrecord.ArgumentReplay.recipes(io.StringIO(self.trail)))
+
+    def time_build_dependencies(self, recipes):
+        argrecord.argreplay.build_dependencies(argrecord.argreplay.read_steps(io.StringIO(self.trail)))
+
+class PipeChains():
+
+    params = [10, 100]
+
+    def setup(self, pipedepth):
+        self.trail = synthetic_trail(10000, pipedepth)
+
+    def time_build_dependencies(self, pipedepth):
+        argrecord.argreplay.build_dependencies(argrecord.argreplay.read_steps(io.StringIO(self.trail)))
+
+class RunPipeline():
+
+    params = [2, 16]
+
+    def time_run_pipeline(self, stages):
+        asyncio.run(argrecord.argreplay.run_pipeline([['head', '-c', str(1 << 24), '/dev/zero']] + [['cat']] * (stages - 1), capture=True))
+
+class ReadComments():
+
+    params = [10, 10000]
+
+    def setup(self, headerlines):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'data.csv')
+        with open(self.filename, 'w') as datafile:
+            datafile.write(''.join(synthetic_trail(headerlines // 5 + 1).splitlines(True)[:headerlines]))
+            line = ','.join(str(column) for column in range(20)) + '\n'
+            datafile.write(line * ((1 << 26) // len(line)))
+
+    def teardown(self, headerlines):
+        shutil.rmtree(self.directory)
+
+    def time_read_filename(self, headerlines):
+        argrecord.ArgumentHelper.read_comments(self.filename)
+
+    def time_read_fileobject(self, headerlines):
+        with open(self.filename, 'r') as datafile:
+            argrecord.ArgumentHelper.read_comments(datafile)
+            datafile.readline()
+
+class Staleness():
+
+    params = [1000, 10000]
+
+    def setup(self, recipes):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'data'))
+        for index in range(recipes + 1):
+            open(os.path.join(self.directory, 'data', 'f' + str(index) + '.txt'), 'w').close()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.steps = argrecord.argreplay.build_dependencies(argrecord.argreplay.read_steps(io.StringIO(synthetic_trail(recipes))))
+
+    def teardown(self, recipes):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def time_plan(self, recipes):
+        argrecord.argreplay.Replayer(verbosity=0).plan(self.steps)
+
+    def time_plan_threads(self, recipes):
+        argrecord.argreplay.Replayer(verbosity=0, stat_threads=8).plan(self.steps)
+
+benchmarks = [BuildComments, ParseTrail, PipeChains, RunPipeline, ReadComments, Staleness]
+
+def run(repeat=3, quick=False, select=None):
+    # Times are the best of repeat runs, in seconds. Memory is the peak of memory allocated
+    # by Python while the method ran, in bytes, which unlike asv leaves out the memory the
+    # process was already using.
+    results = {}
+    for benchmark in benchmarks:
+        for param in (benchmark.params[:1] if quick else benchmark.params):
+            names = [name for name in sorted(dir(benchmark)) if name.startswith(('time_', 'peakmem_'))
+                     and not (select and select not in benchmark.__name__ + '.' + name + '(' + str(param) + ')')]
+            if not names:
+                continue
+
+            instance = benchmark()
+            if hasattr(instance, 'setup'):
+                instance.setup(param)
+            try:
+                for name in names:
+                    key = benchmark.__name__ + '.' + name + '(' + str(param) + ')'
+                    method = getattr(instance, name)
+                    if name.startswith('time_'):
+                        times = []
+                        for attempt in range(repeat):
+                            starttime = time.perf_counter()
+                            method(param)
+                            times.append(time.perf_counter() - starttime)
+                        results[key] = min(times)
+                        print(key.ljust(56) + ' ' + format(results[key], '.6f') + ' s', file=sys.stderr)
+                    elif name.startswith('peakmem_'):
+                        tracemalloc.start()
+                        method(param)
+                        results[key] = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                        print(key.ljust(56) + ' ' + format(results[key] / (1 << 20), '.1f') + ' MB', file=sys.stderr)
+            finally:
+                if hasattr(instance, 'teardown'):
+                    instance.teardown(param)
+
+    return results
+
+def compare(results, baseline, tolerance):
+    # Benchmarks that have become slower or use more memory than tolerance allows
+    return [key for key in sorted(results) if key in baseline and baseline[key] and results[key] > baseline[key] * tolerance]
+
+def main(arglist=None):
+    parser = argparse.ArgumentParser(description='Benchmark recording and replay.')
+    parser.add_argument('-r', '--repeat',    type=int, default=3, help='Number of times to time each benchmark.')
+    parser.add_argument('-q', '--quick',     action='store_true', help='Run each benchmark with its first parameter only.')
+    parser.add_argument('-b', '--bench',     type=str, help='Run only the benchmarks whose names contain this.')
+    parser.add_argument('-s', '--save',      type=str, help='File in which to save the results as JSON.')
+    parser.add_argument('-c', '--compare',   type=str, help='File of results saved earlier to compare with.')
+    parser.add_argument('-t', '--tolerance', type=float, default=1.25, help='Ratio to an earlier result above which a result is a regression.')
+    args = parser.parse_args(arglist)
+
+    results = run(args.repeat, args.quick, args.bench)
+    if args.save:
+        with open(args.save, 'w') as savefile:
+            json.dump(results, savefile, indent=1)
+
+    if args.compare:
+        with open(args.compare, 'r') as comparefile:
+            regressions = compare(results, json.load(comparefile), args.tolerance)
+        for key in regressions:
+            print("Regression: " + key, file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
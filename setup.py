@@ -16,7 +16,8 @@ setup(
     packages = ["argrecord"],
     install_requires = ["argparse"],
     entry_points = {
-        "console_scripts": ['argreplay = argrecord.argreplay:main']
+        "console_scripts": ['argreplay = argrecord.argreplay:main',
+                            'argreplay-worker = argrecord.argreplay:worker_main']
         },
     include_package_data=True,
     classifiers = [
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
 import argrecord
 import argrecord.argreplay
+import io
 import shutil
 import os
 import sys
@@ -61,5 +63,72 @@ def test_copy():
     argrecord.argreplay.main(['test_pipe.log'])
     assert(os.path.isfile('out.txt'))
 
+def test_read_comments(tmp_path):
+    filename = str(tmp_path / 'data.csv')
+    datafile = open(filename, 'w')
+    datafile.write("# first\n# second\n" + "a,b\n" * 100000)
+    datafile.close()
+
+    print("Test comments are read and the file is left at the data")
+    infile = open(filename, 'r')
+    assert(argrecord.ArgumentHelper.read_comments(infile) == "# first\n# second\n")
+    assert(infile.readline() == "a,b\n")
+    infile.close()
+    assert(argrecord.ArgumentHelper.read_comments(filename) == "# first\n# second\n")
+
+    print("Test comment lines longer than a chunk are read whole")
+    long = "# " + "x" * 100 + "\n"
+    for header in ["# a\n" + long + "# b\n", long, "# a\n" + long[:-1]]:
+        for data in ["a,b\n", ""] if header.endswith("\n") else [""]:
+            for source in [io.StringIO(header + data), io.BytesIO((header + data).encode())]:
+                original = argrecord.ArgumentHelper.chunksize
+                argrecord.ArgumentHelper.chunksize = 16
+                try:
+                    comments = argrecord.ArgumentHelper.read_comments(source)
+                finally:
+                    argrecord.ArgumentHelper.chunksize = original
+                assert((comments if isinstance(comments, str) else comments.decode()) == header)
+                assert(source.read() in (data, data.encode()))
+
+    print("Test header size guard")
+    try:
+        argrecord.ArgumentHelper.read_comments(filename, max_size=10)
+        assert(False)
+    except RuntimeError:
+        pass
+    try:
+        argrecord.ArgumentHelper.read_comments(io.StringIO(long + "a,b\n"), max_size=10)
+        assert(False)
+    except RuntimeError:
+        pass
+
+def test_build_comments():
+    print("Test positional and optional arguments are recorded")
+    parser = argrecord.ArgumentRecorder('tool')
+    parser.add_argument('--count', type=int)
+    parser.add_argument('--secret', type=str, private=True)
+    group = parser.add_argument_group('Files')
+    group.add_argument('--output_file', type=str, output=True)
+    parser.add_argument('input_file', nargs='+', type=str, input=True)
+    args = parser.parse_args(['--count', '2', '--secret', 'x', '--output_file', 'b.txt', 'a.txt', 'c.txt'])
+    assert(parser.build_comments(args).splitlines()[1:] == ['# tool',
+                                                            '#    --count 2',
+                                                            '#>   --output_file "b.txt"',
+                                                            '#<    "a.txt"',
+                                                            '#<    "c.txt"'])
+
+    print("Test arguments inherited from parent parsers are recorded")
+    recorderparent = argrecord.ArgumentRecorder(add_help=False)
+    recorderparent.add_argument('--input_file', type=str, input=True)
+    plainparent = argparse.ArgumentParser(add_help=False)
+    plaingroup = plainparent.add_argument_group('Plain')
+    plaingroup.add_argument('--level', type=int)
+    parser = argrecord.ArgumentRecorder('tool', parents=[recorderparent, plainparent])
+    parser.add_argument('--output_file', type=str, output=True)
+    args = parser.parse_args(['--input_file', 'a.txt', '--level', '3'])
+    assert(parser.build_comments(args).splitlines()[1:] == ['#> tool',
+                                                            '#<   --input_file "a.txt"',
+                                                            '#    --level 3'])
+
 if __name__ == '__main__':
     copy(sys.argv[1:])
\ No newline at end of file
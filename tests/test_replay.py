@@ -0,0 +1,707 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argrecord
+import argrecord.argreplay
+import os
+import io
+import json
+import sys
+
+TRAIL = '''################################################################################
+#  sh
+#    -c "cat $0 $1 > $2"
+#<   "b.txt"
+#<   "d.txt"
+#>   "e.txt"
+################################################################################
+#  cp
+#<   "c.txt"
+#>   "d.txt"
+################################################################################
+#  cp
+#<   "a.txt"
+#>   "b.txt"
+'''
+
+def write_file(filename, text):
+    outfile = open(filename, 'w')
+    outfile.write(text)
+    outfile.close()
+
+def test_jobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', TRAIL)
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+
+    print("Test independent recipes do not depend on each other")
+    with open('trail.log', 'r') as infile:
+        steps = argrecord.argreplay.build_dependencies(argrecord.argreplay.read_steps(infile))
+    assert([step.pipestack[0][0] for step in steps] == ['cp', 'cp', 'sh'])
+    assert(not steps[0].dependencies and not steps[1].dependencies)
+    assert(steps[2].dependencies == { steps[0], steps[1] })
+
+    print("Test concurrent replay runs every recipe")
+    argrecord.argreplay.main(['trail.log', '--jobs', '2'])
+    assert(open('e.txt').read() == "a\nc\n")
+
+def test_hash(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', TRAIL)
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+    argrecord.argreplay.main(['trail.log', '--hash'])
+    assert(os.path.isfile(argrecord.HashCache.default_filename))
+
+    print("Test touching an input does not trigger a replay")
+    os.utime('e.txt', (0, 0))
+    os.utime('a.txt')
+    argrecord.argreplay.main(['trail.log', '--hash'])
+    assert(os.path.getmtime('e.txt') == 0)
+
+    print("Test changing an input does trigger a replay")
+    write_file('a.txt', "A\n")
+    argrecord.argreplay.main(['trail.log', '--hash'])
+    assert(open('e.txt').read() == "A\nc\n")
+
+def test_recipes():
+    trail = io.StringIO('''################################################################################
+#>count wc
+#    -l "first line
+second \\"line\\""
+## comment
+#<   "in.txt"
+''' + TRAIL)
+
+    print("Test recipes are parsed one by one")
+    recipes = argrecord.ArgumentReplay.recipes(trail)
+    replay = next(recipes)
+    assert(replay.command == ['wc', '-l', 'first line\nsecond "line"', 'in.txt'])
+    assert(replay.outvar == 'count' and replay.inputs == ['in.txt'])
+    assert([replay.command[0] for replay in recipes] == ['sh', 'cp', 'cp'])
+
+def test_sidecar(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser = argrecord.ArgumentRecorder('cp')
+    parser.add_argument('--input_file',  type=str, input=True)
+    parser.add_argument('--output_file', type=str, output=True)
+
+    print("Test sidecar is written alongside the log")
+    parser.write_comments(parser.parse_args(['--input_file', 'a.txt', '--output_file', 'b.txt']), 'cp.log', sidecar=True)
+    assert(os.path.isfile('cp.log' + argrecord.ArgumentReplay.sidecarsuffix))
+    assert(argrecord.ArgumentReplay.read_sidecar('cp.log') is not None)
+    replay = next(argrecord.ArgumentReplay.recipes('cp.log'))
+    assert(replay.inputs == ['a.txt'] and replay.outputs == ['b.txt'])
+
+    print("Test sidecar is ignored once the header has changed")
+    parser.write_comments(parser.parse_args(['--input_file', 'c.txt', '--output_file', 'd.txt']), 'cp.log')
+    assert(argrecord.ArgumentReplay.read_sidecar('cp.log') is None)
+    replay = next(argrecord.ArgumentReplay.recipes('cp.log'))
+    assert(replay.inputs == ['c.txt'] and replay.outputs == ['d.txt'])
+
+def test_prepend(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser = argrecord.ArgumentRecorder('cp')
+    parser.add_argument('--input_file',  type=str, input=True)
+    parser.add_argument('--output_file', type=str, output=True)
+
+    print("Test data is streamed after the header")
+    with parser.open_output(parser.parse_args(['--output_file', 'b.txt']), 'b.txt') as outfile:
+        outfile.write("data\n" * 1000)
+    assert(argrecord.ArgumentHelper.read_comments('b.txt') == parser.build_comments(parser.parse_args(['--output_file', 'b.txt'])))
+
+    print("Test header is spliced onto an existing file")
+    parser.prepend_comments(parser.parse_args(['--input_file', 'b.txt', '--output_file', 'b.txt']), 'b.txt', backup='.bak')
+    comments = argrecord.ArgumentHelper.read_comments('b.txt')
+    assert(comments.count(argrecord.ArgumentHelper.separator()) == 2)
+    assert(open('b.txt').read() == comments + "data\n" * 1000)
+    assert(open('b.txt.bak').read().endswith("data\n" * 1000))
+
+def test_replayer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', TRAIL)
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+    replayer = argrecord.argreplay.Replayer(verbosity=0)
+
+    print("Test parsed trails are reused")
+    steps = replayer.load('trail.log')
+    assert(replayer.load('trail.log') is steps)
+    assert(len(replayer.plan(steps)) == 3)
+
+    print("Test results are returned for each step")
+    results = replayer.execute(steps)
+    assert([result.step for result in results] == steps)
+    assert(all(result.executed and result.returncode == 0 for result in results))
+    assert(replayer.plan(steps) == [])
+    assert(not any(result.executed for result in replayer.replay('trail.log')))
+
+def test_statcache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_file('a.txt', "a\n")
+    statcache = argrecord.StatCache(threads=2)
+    statcache.prefetch(['a.txt', 'b.txt', './a.txt'])
+    assert(set(statcache.stats.keys()) == { 'a.txt', 'b.txt' })
+
+    print("Test missing outputs have no earliest timestamp")
+    assert(argrecord.ArgumentHelper.latest_timestamp(['a.txt', 'b.txt'], statcache) is not None)
+    assert(argrecord.ArgumentHelper.earliest_timestamp(['a.txt', 'b.txt'], statcache) is None)
+
+    print("Test cached results are kept until invalidated")
+    write_file('b.txt', "b\n")
+    assert(statcache.stat('b.txt') is None)
+    statcache.invalidate(['./b.txt'])
+    assert(statcache.stat('b.txt') is not None)
+
+def test_substitution(tmp_path, monkeypatch):
+    print("Test substitutions are rendered against several sets of values")
+    template = argrecord.SubstitutionTemplate('${name}-${year//0/o}-${year/0/o}.txt')
+    assert(template.names == { 'name', 'year' })
+    assert(template.render_all([{ 'name': 'a', 'year': '2000' }, { 'name': 'b', 'year': '2010' }]) == ['a-2ooo-2o00.txt', 'b-2o1o-2o10.txt'])
+
+    print("Test ranges are expanded")
+    substitutes = argrecord.argreplay.expand_substitutes({ 'name': 'a', 'month': '09..11' })
+    assert([substitute['month'] for substitute in substitutes] == ['09', '10', '11'])
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', '''################################################################################
+#  cp
+#<   "in${n}.txt"
+#>   "out${n}.txt"
+''')
+    for n in range(1, 4):
+        write_file('in' + str(n) + '.txt', str(n))
+    argrecord.argreplay.main(['trail.log', '--substitute', 'n:1..3'])
+    assert([open('out' + str(n) + '.txt').read() for n in range(1, 4)] == ['1', '2', '3'])
+
+def test_sweep(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', '''################################################################################
+#  sh
+#    -c "cat $0; echo ${n}${m}"
+#<   "in${n}.txt"
+''')
+    write_file('sweep.def', "n:1\nn:2\nm:a\nm:b\n")
+    for n in range(1, 3):
+        write_file('in' + str(n) + '.txt', str(n))
+
+    print("Test every combination of values is replayed in its own directory")
+    argrecord.argreplay.main(['trail.log', '--sweep', 'sweep.def', '--sweep-jobs', '2', '--sweep-dir', 'sweep'])
+    assert(sorted(os.listdir('sweep')) == ['n=1,m=a', 'n=1,m=b', 'n=2,m=a', 'n=2,m=b'])
+    assert(open(os.path.join('sweep', 'n=2,m=b', 'stdout.txt')).read() == "22b\n")
+
+    print("Test combinations may not write to the same output files")
+    for trailname, output in [('same.log', 'out.txt'), ('trail.log', '${sweepdir}/out.txt')]:
+        write_file(trailname, '''################################################################################
+#  sh
+#    -c "cat $0 > $1; echo ${n} >> $1"
+#<   "in${n}.txt"
+#>   "''' + output + '''"
+''')
+    write_file('sweep.def', "n:1\nn:2\n")
+    try:
+        argrecord.argreplay.main(['same.log', '--sweep', 'sweep.def', '--sweep-dir', 'sweep'])
+        assert(False)
+    except RuntimeError as error:
+        assert("out.txt" in str(error))
+    assert(not os.path.exists('out.txt'))
+    argrecord.argreplay.main(['trail.log', '--sweep', 'sweep.def', '--sweep-jobs', '2', '--sweep-dir', 'sweep'])
+    assert(open(os.path.join('sweep', 'n=2', 'out.txt')).read() == "22\n")
+
+    print("Test recipes that do not depend on the swept variables are replayed once")
+    write_file('trail.log', '''################################################################################
+#  sh
+#    -c "cat $0 > $1; echo ${v}${n} >> $1"
+#<   "shared.txt"
+#>   "out${n}.txt"
+################################################################################
+#>v sh
+#    -c "printf v"
+################################################################################
+#  sh
+#    -c "cat $0 >> $1"
+#<   "a.txt"
+#>   "shared.txt"
+''')
+    write_file('a.txt', "a\n")
+    write_file('sweep.def', "n:1..3\n")
+    argrecord.argreplay.main(['trail.log', '--sweep', 'sweep.def', '--sweep-jobs', '2'])
+    assert(open('shared.txt').read() == "a\n")
+    assert([open('out' + str(n) + '.txt').read() for n in range(1, 4)] == ["a\nv1\n", "a\nv2\n", "a\nv3\n"])
+
+def test_profile(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', TRAIL)
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+
+    print("Test timings are written for each step")
+    argrecord.argreplay.main(['trail.log', '--stats-file', 'stats.json'])
+    records = [json.loads(line) for line in open('stats.json')]
+    assert([record['type'] for record in records] == ['trail', 'step', 'step', 'step', 'summary'])
+    assert(all(record['returncode'] == 0 and record['wait'] is not None for record in records[1:4]))
+    assert(records[-1]['critical_path'][-1] == 2 and len(records[-1]['critical_path']) == 2)
+
+def test_buildcache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', TRAIL)
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+    argrecord.argreplay.main(['trail.log', '--build-cache', 'cache'])
+
+    print("Test outputs are restored from the cache")
+    os.remove('e.txt')
+    os.remove('b.txt')
+    replayer = argrecord.argreplay.Replayer(verbosity=0, buildcache=argrecord.BuildCache('cache'))
+    results = replayer.replay('trail.log')
+    assert([result.restored for result in results] == [True, False, True])
+    assert(open('e.txt').read() == "a\nc\n")
+
+    print("Test the cache is only looked through when it may be too large")
+    assert(open(os.path.join('cache', 'size')).read() == str(len("a\n") + len("c\n") + len("a\nc\n")))
+    evictions = []
+    evict = argrecord.BuildCache.evict
+    monkeypatch.setattr(argrecord.BuildCache, 'evict', lambda self: evictions.append(self) or evict(self))
+    write_file('c.txt', "C\n")
+    argrecord.argreplay.main(['trail.log', '--build-cache', 'cache'])
+    assert(not evictions)
+    assert(open(os.path.join('cache', 'size')).read() == str(len("a\n") + 2 * len("c\n") + 2 * len("a\nc\n")))
+
+    print("Test least recently used entries are evicted")
+    argrecord.BuildCache('cache', maxsize=4).evict()
+    assert(sum(len(os.listdir(os.path.join('cache', prefix))) for prefix in os.listdir('cache') if len(prefix) == 2) == 1)
+    assert(int(open(os.path.join('cache', 'size')).read()) <= 4)
+    write_file('c.txt', "CC\n")
+    argrecord.argreplay.main(['trail.log', '--build-cache', 'cache', '--build-cache-size', '0'])
+    assert(len(evictions) == 3 and open(os.path.join('cache', 'size')).read() == "0")
+
+def test_append_log(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    parser = argrecord.ArgumentRecorder('cp')
+    parser.add_argument('input_file',  type=str, input=True)
+    parser.add_argument('output_file', type=str, output=True)
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+    parser.append_log(parser.parse_args(['a.txt', 'b.txt']), 'cp.log')
+    parser.append_log(parser.parse_args(['c.txt', 'd.txt']), 'cp.log')
+    parser.append_log(parser.parse_args(['c.txt', 'b.txt']), 'cp.log')
+
+    print("Test entries are read newest first")
+    assert([replay.inputs for replay in argrecord.ArgumentReplay.recipes('cp.log')] == [['c.txt'], ['c.txt'], ['a.txt']])
+
+    print("Test log is read backwards without its index")
+    os.rename('cp.log' + argrecord.ArgumentReplay.indexsuffix, 'cp.idx')
+    assert([replay.inputs for replay in argrecord.ArgumentReplay.recipes('cp.log')] == [['c.txt'], ['c.txt'], ['a.txt']])
+    argrecord.argreplay.main(['cp.log', '--force'])
+    assert(open('b.txt').read() == "c\n" and open('d.txt').read() == "c\n")
+    os.rename('cp.idx', 'cp.log' + argrecord.ArgumentReplay.indexsuffix)
+
+    print("Test compaction drops superseded entries")
+    argrecord.argreplay.main(['cp.log', '--compact'])
+    assert([replay.outputs for replay in argrecord.ArgumentReplay.recipes('cp.log')] == [['b.txt'], ['d.txt']])
+    assert(argrecord.ArgumentReplay.read_index('cp.log', os.path.getsize('cp.log'), len(argrecord.ArgumentReplay.logmarker)) is not None)
+    assert(open('b.txt').read() == "c\n")
+
+def shard_worker(count):
+    parser = argrecord.ArgumentRecorder('cp')
+    parser.add_argument('input_file',  type=str, input=True)
+    parser.add_argument('output_file', type=str, output=True)
+    for index in range(count):
+        parser.write_comments(parser.parse_args(['a.txt', str(os.getpid()) + '.' + str(index)]), 'shared.log', append=True, lock=True)
+        parser.append_log(parser.parse_args(['a.txt', str(os.getpid()) + '.' + str(index)]), 'sharded.log', shard=True)
+
+def test_concurrent_log(tmp_path, monkeypatch):
+    import multiprocessing
+    monkeypatch.chdir(tmp_path)
+
+    print("Test concurrent writers do not lose each other's comments")
+    processes = [multiprocessing.Process(target=shard_worker, args=(20,)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert(len(list(argrecord.ArgumentReplay.recipes('shared.log'))) == 80)
+
+    print("Test shards are merged newest first and folded in by compaction")
+    assert(len(argrecord.ArgumentReplay.shards('sharded.log')) == 4)
+    assert(len(list(argrecord.ArgumentReplay.recipes('sharded.log'))) == 80)
+    times = [entrytime for entrytime, entry in argrecord.ArgumentReplay.merged_entries('sharded.log')]
+    assert(times == sorted(times, reverse=True))
+    argrecord.ArgumentReplay.compact_log('sharded.log')
+    assert(not argrecord.ArgumentReplay.shards('sharded.log'))
+    assert(len(list(argrecord.ArgumentReplay.recipes('sharded.log'))) == 80)
+
+def test_linked_log(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser = argrecord.ArgumentRecorder('cp')
+    parser.add_argument('input_file',  type=str, input=True)
+    parser.add_argument('output_file', type=str, output=True)
+
+    print("Test a log that is a link is updated through the link")
+    os.mkdir('logs')
+    parser.write_comments(parser.parse_args(['a.txt', 'b.txt']), os.path.join('logs', 'real.log'))
+    os.symlink(os.path.join('logs', 'real.log'), 'link.log')
+    parser.write_comments(parser.parse_args(['b.txt', 'c.txt']), 'link.log', append=True, backup='.bak')
+    parser.prepend_comments(parser.parse_args(['c.txt', 'd.txt']), 'link.log')
+    assert(os.path.islink('link.log'))
+    assert([replay.outputs for replay in argrecord.ArgumentReplay.recipes(os.path.join('logs', 'real.log'))] == [['d.txt'], ['c.txt'], ['b.txt']])
+    assert(os.path.isfile(os.path.join('logs', 'real.log.bak')))
+
+    print("Test only shared logs leave a lock file")
+    assert(not [filename for filename in os.listdir('.') + os.listdir('logs') if filename.endswith(argrecord.ArgumentHelper.locksuffix)])
+    parser.write_comments(parser.parse_args(['a.txt', 'b.txt']), 'shared.log', lock=True)
+    assert(os.path.isfile('shared.log' + argrecord.ArgumentHelper.locksuffix))
+
+def test_pipeline(tmp_path, monkeypatch):
+    import asyncio
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+
+    print("Test large outputs pass through a pipeline and are captured in full")
+    returncodes, usages, output = asyncio.run(argrecord.argreplay.run_pipeline([['sh', '-c', 'yes | head -c 10000000'], ['wc', '-c']], capture=True))
+    assert(returncodes == [0, 0] and output.strip() == '10000000')
+    returncodes, usages, output = asyncio.run(argrecord.argreplay.run_pipeline([['head', '-c', '1000000', '/dev/zero']], capture=True))
+    assert(len(output) == 1000000)
+
+    print("Test every stage is reaped and its exit code reported")
+    returncodes, usages, output = asyncio.run(argrecord.argreplay.run_pipeline([['sh', '-c', 'exit 3'], ['cat']]))
+    assert(returncodes == [3, 0] and argrecord.argreplay.pipeline_returncode(returncodes) == 3)
+
+    print("Test a stage whose reader stops early is not left blocked")
+    returncodes, usages, output = asyncio.run(argrecord.argreplay.run_pipeline([['yes'], ['head', '-n', '1']], capture=True))
+    assert(output == "y\n" and argrecord.argreplay.pipeline_returncode(returncodes) == 0)
+
+def test_resolver(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    os.mkdir('bin')
+    monkeypatch.setenv('PATH', str(tmp_path / 'bin') + os.pathsep + os.environ['PATH'])
+    resolver = argrecord.PathResolver()
+
+    print("Test commands are found on PATH and new ones found after a refresh")
+    assert(resolver.lookup('sh') and resolver.lookup('nosuchcommand') is None)
+    write_file('bin/nosuchcommand', "#!/bin/sh\n")
+    os.chmod('bin/nosuchcommand', 0o755)
+    assert(resolver.lookup('nosuchcommand') is None)
+    resolver.refresh()
+    assert(resolver.lookup('nosuchcommand') == str(tmp_path / 'bin' / 'nosuchcommand'))
+
+    print("Test every missing command is reported before anything is run")
+    write_file('trail.log', TRAIL.replace('#  sh', '#  missing1').replace('#  cp\n#<   "c.txt"', '#  missing2\n#<   "c.txt"'))
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+    try:
+        argrecord.argreplay.main(['trail.log'])
+        assert(False)
+    except RuntimeError as error:
+        assert(str(error) == "Commands not found: missing1, missing2")
+    assert(not os.path.exists('b.txt'))
+
+def test_plan(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', TRAIL)
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+    argrecord.argreplay.main(['trail.log', '--stats-file', 'stats.json'])
+
+    print("Test steps downstream of a changed input are planned without being run")
+    os.utime('c.txt', (os.path.getmtime('e.txt') + 10, os.path.getmtime('e.txt') + 10))
+    capsys.readouterr()
+    argrecord.argreplay.main(['trail.log', '--plan', '--history', 'stats.json', '--stats-file', 'plan.json'])
+    records = [json.loads(line) for line in open('plan.json')]
+    assert([(record['index'], record['reason']) for record in records[:-1]] == [(1, 'stale'), (2, 'upstream')])
+    assert(all(record['estimate'] is not None for record in records[:-1]))
+    assert(records[-1]['steps'] == 2 and records[-1]['unknown'] == 0)
+    assert("2 steps to rebuild" in capsys.readouterr().out)
+    assert(os.path.getmtime('d.txt') < os.path.getmtime('c.txt'))
+
+SHARED = '''################################################################################
+#  sh
+#    -c "echo run >> count.txt; cat $0 > $1"
+#<   "a.txt"
+#>   "b.txt"
+'''
+
+def test_merge(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('x.log', '''################################################################################
+#  cp
+#<   "b.txt"
+#>   "x.txt"
+''' + SHARED)
+    write_file('y.log', '''################################################################################
+#  cp
+#<   "b.txt"
+#>   "y.txt"
+''' + SHARED)
+    write_file('a.txt', "a\n")
+
+    print("Test a recipe shared by several trails is run once")
+    replayer = argrecord.argreplay.Replayer(verbosity=0)
+    steps = replayer.load_all(['x.log', 'y.log'])
+    assert(len(steps) == 3 and steps[1].dependencies == { steps[0] } and steps[2].dependencies == { steps[0] })
+    assert(not replayer.load('x.log')[0].dependents & set(steps))
+    argrecord.argreplay.main(['x.log', 'y.log'])
+    assert(open('count.txt').read() == "run\n")
+    assert(open('x.txt').read() == "a\n" and open('y.txt').read() == "a\n")
+
+    print("Test a new recipe comes after the shared recipes it depends on")
+    p1 = '''################################################################################
+#  cp
+#<   "a.txt"
+#>   "p1.txt"
+'''
+    p2 = '''################################################################################
+#  cp
+#<   "a.txt"
+#>   "p2.txt"
+'''
+    write_file('a.log', p2 + p1)
+    write_file('b.log', p1 + '''################################################################################
+#  cp
+#<   "p2.txt"
+#>   "q.txt"
+''' + p2)
+    steps = replayer.load_all(['a.log', 'b.log'])
+    assert([step.outputs for step in steps] == [['p1.txt'], ['p2.txt'], ['q.txt']])
+    assert(not steps[1].dependencies and steps[2].dependencies == { steps[1] })
+
+def test_import_time():
+    import subprocess
+    print("Test argreplay imports nothing it does not need to start")
+    script = "import sys, time; start = time.perf_counter(); import argrecord.argreplay; print(time.perf_counter() - start); print(' '.join(sorted(sys.modules)))"
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))).stdout.splitlines()
+    modules = output[1].split()
+    assert(not [module for module in ('asyncio', 'concurrent.futures', 'gooey', 'wx') if module in modules])
+    assert(float(output[0]) < 0.5)
+
+def test_python_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    monkeypatch.setattr(sys, 'stdout', open('stdout.txt', 'w'))
+    monkeypatch.setenv('PATH', os.path.dirname(sys.executable) + os.pathsep + os.environ['PATH'])
+    write_file('tool.py', "#!/usr/bin/env python3\nimport atexit, os, sys\natexit.register(lambda: open('exit.txt', 'a').write(sys.argv[1]))\n"
+                          "open(sys.argv[2], 'w').write(str(os.getppid()))\nprint(sys.argv[1])\nsys.exit(int(sys.argv[1]))\n")
+    os.chmod('tool.py', 0o755)
+    write_file('a.txt', "a\n")
+    write_file('trail.log', '''################################################################################
+#  python3
+#    "tool.py"
+#    "3"
+#>   "c.txt"
+#<   "b.txt"
+################################################################################
+#  ./tool.py
+#    "0"
+#>   "b.txt"
+#<   "a.txt"
+''')
+
+    print("Test Python recipes are recognised")
+    assert(argrecord.argreplay.python_job(['./tool.py', '0']) == ('script', './tool.py', ['0']))
+    assert(argrecord.argreplay.python_job(['python3', '-m', 'json.tool']) == ('module', 'json.tool', []))
+    assert(argrecord.argreplay.python_job(['python3', '-u', 'tool.py']) is None)
+    assert(argrecord.argreplay.python_job(['sh', '-c', 'true']) is None)
+
+    print("Test Python recipes for other interpreters are not recognised")
+    write_file('other.py', "#!/opt/othervenv/bin/python3\n")
+    assert(argrecord.argreplay.python_job(['other.py']) is None)
+    os.makedirs(os.path.join('venv', 'bin'))
+    os.symlink(sys.executable, os.path.join('venv', 'bin', 'python3'))
+    assert(argrecord.argreplay.python_job([os.path.join('venv', 'bin', 'python3'), 'tool.py']) is None)
+    assert(argrecord.argreplay.python_job([os.path.join(os.path.dirname(sys.executable), 'python3.0'), 'tool.py']) is None)
+
+    print("Test Python recipes run in the worker pool with their own arguments and exit codes")
+    replayer = argrecord.argreplay.Replayer(verbosity=0, python_workers=1)
+    try:
+        results = replayer.replay('trail.log')
+    finally:
+        replayer.close()
+    sys.stdout.close()
+    assert([result.returncode for result in results] == [0, 3])
+    assert(open('b.txt').read() == open('c.txt').read() != str(os.getpid()))
+    assert(open('stdout.txt').read().endswith("\n0\n3\n"))
+    assert(open('exit.txt').read() == "03")
+
+    monkeypatch.setattr(sys, 'stdout', sys.__stdout__)
+    print("Test Python recipes use the standard output of each run and not the host's exit handlers")
+    import atexit
+    host = lambda: open('host.txt', 'w').write("host")
+    atexit.register(host)
+    replayer = argrecord.argreplay.Replayer(verbosity=0, force=True, python_workers=1)
+    try:
+        steps = replayer.load('trail.log')
+        for filename in ['first.txt', 'second.txt']:
+            monkeypatch.setattr(sys, 'stdout', open(filename, 'w'))
+            replayer.execute(steps)
+            sys.stdout.close()
+    finally:
+        replayer.close()
+        atexit.unregister(host)
+    assert(open('first.txt').read() == open('second.txt').read() == "0\n3\n")
+    assert(not os.path.exists('host.txt'))
+
+def test_watch(tmp_path, monkeypatch):
+    import threading
+    import time
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', TRAIL)
+    for inotify in [True, False]:
+        write_file('a.txt', "a\n")
+        write_file('c.txt', "c\n")
+        for filename in ['b.txt', 'd.txt', 'e.txt']:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        replayer = argrecord.argreplay.Replayer(verbosity=0)
+        stop = threading.Event()
+        watch = replayer.watch(['trail.log'], debounce=0.05, interval=0.05, inotify=inotify, stop=stop)
+
+        print("Test watching replays the trail first")
+        changed, steps, results = next(watch)
+        assert(changed == [] and all(result.executed for result in results))
+        assert(open('e.txt').read() == "a\nc\n")
+
+        print("Test a change replays only the recipes downstream of it")
+        write_file('c.txt', "C\n")
+        os.utime('c.txt', (time.time() + 10, time.time() + 10))
+        changed, steps, results = next(watch)
+        assert(changed == ['c.txt'])
+        assert([step.pipestack[0][0] for step in steps] == ['cp', 'sh'] and steps[0].inputs == ['c.txt'])
+        assert(all(result.executed for result in results))
+        assert(open('e.txt').read() == "a\nC\n")
+
+        print("Test files written by the replay do not set off another")
+        write_file('a.txt', "A\n")
+        os.utime('a.txt', (time.time() + 20, time.time() + 20))
+        changed, steps, results = next(watch)
+        assert(changed == ['a.txt'] and len(steps) == 2)
+        assert(open('e.txt').read() == "A\nC\n")
+
+        stop.set()
+        assert(next(watch, None) is None)
+
+def test_distributed(tmp_path, monkeypatch):
+    import subprocess
+    import threading
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', '''################################################################################
+#  sh
+#    -c "test -f marker || { touch marker; exit 1; }; cp $0 $1"
+#<   "a.txt"
+#>   "f.txt"
+''' + TRAIL)
+    write_file('a.txt', "a\n")
+    write_file('c.txt', "c\n")
+
+    print("Test workers on localhost connect to the coordinator")
+    coordinator = argrecord.argreplay.Coordinator(('localhost', 0), retries=1, verbosity=0)
+    thread = threading.Thread(target=argrecord.argreplay.run_worker, args=(coordinator.address, 1, 'one', 0))
+    thread.start()
+    process = subprocess.Popen([sys.executable, '-c', 'import argrecord.argreplay; argrecord.argreplay.worker_main()',
+                                'localhost:' + str(coordinator.address[1]), '--capacity', '2', '--name', 'two', '--verbosity', '0'],
+                               cwd=os.sep, env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    try:
+        coordinator.wait_workers(2, timeout=30)
+        assert(coordinator.capacity() == 3)
+
+        print("Test recipes are run by the workers, in the coordinator's directory, with a failure retried")
+        replayer = argrecord.argreplay.Replayer(verbosity=0, profile=True, coordinator=coordinator)
+        results = replayer.replay('trail.log')
+        assert(all(result.executed and result.returncode == 0 for result in results))
+        assert(open('e.txt').read() == "a\nc\n" and open('f.txt').read() == "a\n")
+        assert(set(result.worker for result in results) <= { 'one', 'two' })
+        assert(sorted(result.attempts for result in results) == [1, 1, 1, 2])
+        assert(all(result.usertime is not None for result in results))
+        summary = coordinator.summary()
+        assert(sum(record['jobs'] for record in summary) == 5 and sum(record['failures'] for record in summary) == 1)
+    finally:
+        coordinator.close()
+        thread.join()
+        assert(process.wait() == 0)
+
+def test_watch_outvar(tmp_path, monkeypatch):
+    import threading
+    import time
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull, 'r'))
+    write_file('trail.log', '''################################################################################
+#  sh
+#    -c "cat $0 > $1; echo ${v} >> $1"
+#<   "b.txt"
+#>   "out.txt"
+################################################################################
+#>v sh
+#    -c "cat $0"
+#<   "a.txt"
+''')
+    write_file('a.txt', "x")
+    write_file('b.txt', "b\n")
+    replayer = argrecord.argreplay.Replayer(verbosity=0)
+    stop = threading.Event()
+    watch = replayer.watch(['trail.log'], debounce=0.05, interval=0.05, stop=stop)
+    changed, steps, results = next(watch)
+    assert(open('out.txt').read() == "b\nx\n")
+
+    print("Test a variable captured by a step that is not run again is kept")
+    write_file('b.txt', "B\n")
+    os.utime('b.txt', (time.time() + 10, time.time() + 10))
+    changed, steps, results = next(watch)
+    assert(changed == ['b.txt'] and len(steps) == 1)
+    assert(open('out.txt').read() == "B\nx\n")
+
+    print("Test a change to the captured input runs both steps")
+    write_file('a.txt', "y")
+    os.utime('a.txt', (time.time() + 20, time.time() + 20))
+    changed, steps, results = next(watch)
+    assert(changed == ['a.txt'] and len(steps) == 2)
+    assert(open('out.txt').read() == "B\ny\n")
+    stop.set()
+    assert(next(watch, None) is None)
+
+def test_distributed_lost(tmp_path, monkeypatch):
+    import socket
+    import threading
+    import time
+    monkeypatch.chdir(tmp_path)
+    coordinator = argrecord.argreplay.Coordinator(('localhost', 0), retries=2, verbosity=0, timeout=0.5, token='secret')
+    try:
+        print("Test a worker with the wrong token is sent nothing")
+        stranger = socket.create_connection(coordinator.address)
+        stranger.sendall(b'{"type": "hello", "name": "stranger", "capacity": 1, "token": "guess"}\n')
+        assert(stranger.recv(1024) == b'')
+        stranger.close()
+        assert(coordinator.capacity() == 0)
+
+        print("Test losing the only worker gives up rather than waiting for ever")
+        def lost():
+            connection = socket.create_connection(coordinator.address)
+            connection.sendall(b'{"type": "hello", "name": "lost", "capacity": 1, "token": "secret"}\n')
+            connection.makefile('r').readline()
+            connection.close()
+        thread = threading.Thread(target=lost)
+        thread.start()
+        coordinator.wait_workers(1, timeout=10)
+        starttime = time.monotonic()
+        try:
+            coordinator.run([['true']])
+            assert(False)
+        except RuntimeError as error:
+            assert("No workers" in str(error))
+        assert(time.monotonic() - starttime < 10)
+        thread.join()
+    finally:
+        coordinator.close()